@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Compare ``linkify`` with the regex that used to linkify question and
+answer bodies, on 100 KB bodies. Needs nothing from App Engine:
+
+    python bench_linkify.py
+"""
+import re
+import time
+
+from linkify import linkify
+
+BODY_SIZE = 100 * 1024
+
+# the linkifier before linkify.py, as it was in zhidaoa.py
+LEGACY_PATTERN = r'[a-zA-Z0-9]+://(?:[a-zA-Z0-9_]+:[a-zA-Z0-9_]+@)?(?:[a-zA-Z0-9.-]+\.[A-Za-z]{2,4})(?::[0-9]+)?(?:/[^ \.]*)?(\.[^\s]*)?'
+
+def url_repl(m):
+    ext = m.group(1)
+    if ext in ['.png', '.jpg', '.gif']:
+        return "<img src='%s'>" % m.group(0)
+    else:
+        return "<a href='%s'>%s</a>" % (m.group(0), m.group(0))
+
+def parse_content(content):
+    return re.sub(LEGACY_PATTERN, url_repl, content)
+
+
+def fill(unit):
+    return (unit * (BODY_SIZE // len(unit) + 1))[:BODY_SIZE]
+
+BODIES = [
+    ('prose with links',
+     fill(u'Have a look at http://example.com/docs/page.html and the '
+          u'screenshot http://example.com/img/shot.png before asking. ')),
+    ('editor html',
+     fill(u'<p>See <a href="http://example.com/a">the docs</a> or '
+          u'https://example.org/b?x=1&amp;y=2 for details.</p>\n')),
+    ('long words', fill(u'a' * 5000 + u' ')),
+    ('dotted host', fill(u'http://' + u'a.' * 2000 + u' ')),
+]
+
+
+def timed(function, body):
+    start = time.time()
+    html = function(body)
+    return time.time() - start, html.count(u'<a ') + html.count(u'<img ')
+
+
+def main():
+    print '%-18s %12s %8s %12s %8s' % ('body', 'regex (s)', 'links',
+                                      'linkify (s)', 'links')
+    for name, body in BODIES:
+        legacy_time, legacy_links = timed(parse_content, body)
+        new_time, new_links = timed(linkify, body)
+        print '%-18s %12.4f %8d %12.4f %8d' % (name, legacy_time, legacy_links,
+                                              new_time, new_links)
+
+if __name__ == '__main__':
+    main()
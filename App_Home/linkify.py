@@ -0,0 +1,210 @@
+"""
+Turns the URLs in question and answer bodies into links, or into images
+when they point at one, and keeps only the safe part of their markup.
+
+The bodies are HTML from the editor, so the input is split into tags and
+text with a single forward scan. The tags of ALLOWED_TAGS are written
+again with only their ALLOWED_ATTRIBUTES (links and images only to http
+and https URLs); any other tag is escaped, so it shows as text, and
+comments are dropped. The text between tags is escaped where it is not
+already (stray ``<``, ``>`` and ``&``) and its URLs are linked, except
+inside an existing ``<a>``. Every character is looked at a bounded number
+of times, so the run time is linear in the size of the body whatever it
+contains.
+"""
+import re
+import cgi
+from HTMLParser import HTMLParser
+
+SCHEMES = ('http', 'https', 'ftp')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.gif')
+
+# characters that end a URL, and the ones dropped from its end because
+# they are far more likely to be punctuation around it
+URL_STOP = frozenset(u' \t\r\n\f\v<>"\'')
+URL_TRAILING = u'.,;:!?)]}'
+SCHEME_CHARS = frozenset(u'abcdefghijklmnopqrstuvwxyz'
+                         u'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789')
+TAG_START = frozenset(u'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ/!?')
+
+# what the editor's toolbar produces, plus the links and images made here
+ALLOWED_TAGS = frozenset([
+    u'p', u'br', u'hr', u'div', u'span', u'strong', u'b', u'em', u'i', u'u', u's',
+    u'sub', u'sup', u'abbr', u'blockquote', u'pre', u'code', u'address',
+    u'h1', u'h2', u'h3', u'h4', u'h5', u'h6', u'ul', u'ol', u'li',
+    u'table', u'caption', u'thead', u'tbody', u'tr', u'th', u'td', u'a', u'img'])
+VOID_TAGS = frozenset([u'br', u'hr', u'img'])
+ALLOWED_ATTRIBUTES = {
+    u'a': (u'href', u'title'),
+    u'img': (u'src', u'alt', u'title', u'width', u'height'),
+    u'abbr': (u'title',),
+    u'th': (u'colspan', u'rowspan'),
+    u'td': (u'colspan', u'rowspan'),
+}
+URL_ATTRIBUTES = frozenset([u'href', u'src'])
+SAFE_URL = re.compile(r'https?://', re.IGNORECASE)
+
+ENTITY = re.compile(r'&(?:#[0-9]+|#[xX][0-9a-fA-F]+|[a-zA-Z][a-zA-Z0-9]*);')
+TAG_NAME = re.compile(r'<(/?)([a-zA-Z0-9]*)')
+ATTRIBUTE = re.compile(r'''([^\s"'>/=]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+)))?''')
+
+unescape = HTMLParser().unescape
+
+
+def escape_text(text, out):
+    """
+    Append ``text`` to ``out`` with the characters that would otherwise
+    be read as markup escaped. Entities already in the text are kept.
+    """
+    start = 0
+    amp = text.find(u'&')
+    while amp != -1:
+        out.append(text[start:amp].replace(u'>', u'&gt;'))
+        if ENTITY.match(text, amp):
+            out.append(u'&')
+        else:
+            out.append(u'&amp;')
+        start = amp + 1
+        amp = text.find(u'&', start)
+    out.append(text[start:].replace(u'>', u'&gt;'))
+
+
+def clean_tag(tag, out):
+    """
+    Append an allowed tag to ``out`` with only its allowed attributes,
+    quoted and escaped again, or the tag escaped as text otherwise.
+    """
+    closing, name = TAG_NAME.match(tag).groups()
+    name = name.lower()
+    if name not in ALLOWED_TAGS:
+        out.append(u'&lt;')
+        escape_text(tag[1:], out)
+        return
+    if closing:
+        if name not in VOID_TAGS:
+            out.append(u'</%s>' % name)
+        return
+
+    allowed = ALLOWED_ATTRIBUTES.get(name, ())
+    attributes = []
+    seen = set()
+    start = len(name) + 1
+    for match in ATTRIBUTE.finditer(tag, start, len(tag) - 1):
+        attribute = match.group(1).lower()
+        if attribute not in allowed or attribute in seen:
+            continue
+        seen.add(attribute)
+        value = unescape(match.group(2) or match.group(3) or match.group(4) or u'').strip()
+        if attribute in URL_ATTRIBUTES and not SAFE_URL.match(value):
+            continue
+        attributes.append(u' %s="%s"' % (attribute, cgi.escape(value, True)))
+    out.append(u'<%s%s>' % (name, u''.join(attributes)))
+
+
+def link_url(url, out):
+    escaped = []
+    escape_text(url, escaped)
+    escaped = u''.join(escaped)
+    if url.lower().endswith(IMAGE_EXTENSIONS):
+        out.append(u'<img src="%s">' % escaped)
+    else:
+        out.append(u'<a href="%s">%s</a>' % (escaped, escaped))
+
+
+def linkify_text(text, out):
+    """
+    Append a run of text to ``out``, escaped, with its URLs linked.
+
+    Each ``://`` found is checked by walking back over the scheme, which
+    never goes past the previous ``://``, and forward to the end of the
+    URL, after which the search resumes; so no character is visited more
+    than a few times.
+    """
+    done = 0   # text[:done] is already in out
+    sep = text.find(u'://')
+    while sep != -1:
+        start = sep
+        while start > done and text[start - 1] in SCHEME_CHARS:
+            start -= 1
+        word = text[start:sep].lower()
+        scheme = None
+        for name in SCHEMES:
+            if word.endswith(name) and (scheme is None or len(name) > len(scheme)):
+                scheme = name
+        host = sep + 3
+        if scheme is None or host >= len(text) or text[host] in URL_STOP or text[host] == u'/':
+            sep = text.find(u'://', host)
+            continue
+
+        stop = host
+        while stop < len(text) and text[stop] not in URL_STOP:
+            stop += 1
+        end = stop
+        while end > host and text[end - 1] in URL_TRAILING:
+            end -= 1
+        if end == host:
+            # only punctuation after the scheme: nothing in it can start a
+            # URL either, since it holds no '/'
+            sep = text.find(u'://', stop)
+            continue
+
+        start = sep - len(scheme)
+        escape_text(text[done:start], out)
+        link_url(text[start:end], out)
+        done = end
+        sep = text.find(u'://', end)
+    escape_text(text[done:], out)
+
+
+def linkify(content):
+    """
+    HTML for a question or answer body with its URLs linked.
+    """
+    content = content or u''
+    out = []
+    in_link = False
+    pos = 0
+    # once a '>' or '-->' is missing, it is missing for good
+    no_more_close = False
+    no_more_comment_close = False
+
+    while pos < len(content):
+        lt = content.find(u'<', pos)
+        if lt == -1:
+            lt = len(content)
+        text = content[pos:lt]
+        if in_link:
+            escape_text(text, out)
+        else:
+            linkify_text(text, out)
+        if lt == len(content):
+            break
+
+        gt = -1
+        if not no_more_close and lt + 1 < len(content) and content[lt + 1] in TAG_START:
+            if content.startswith(u'<!--', lt):
+                if not no_more_comment_close:
+                    gt = content.find(u'-->', lt + 4)
+                    if gt == -1:
+                        no_more_comment_close = True
+                    else:
+                        gt += 2
+            else:
+                gt = content.find(u'>', lt + 1)
+                no_more_close = gt == -1
+
+        if gt == -1:
+            out.append(u'&lt;')   # not a tag, just a '<' in the text
+            pos = lt + 1
+            continue
+
+        tag = content[lt:gt + 1]
+        pos = gt + 1
+        if tag.startswith(u'<!--'):
+            continue
+        closing, name = TAG_NAME.match(tag).groups()
+        if name.lower() == u'a':
+            in_link = not closing
+        clean_tag(tag, out)
+
+    return u''.join(out)
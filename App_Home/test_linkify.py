@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+Tests of ``linkify``, the linking and sanitizing of question and answer
+bodies. Needs nothing from App Engine:
+
+    python test_linkify.py
+"""
+import unittest
+
+from linkify import linkify
+
+
+class LinkifyTest(unittest.TestCase):
+
+    def test_links_urls_in_text(self):
+        self.assertEqual(linkify(u'see http://a.com/b, or https://x.org/i.png.'),
+                         u'see <a href="http://a.com/b">http://a.com/b</a>, '
+                         u'or <img src="https://x.org/i.png">.')
+
+    def test_keeps_existing_links(self):
+        self.assertEqual(linkify(u'<a href="http://a.com/">http://a.com/</a>'),
+                         u'<a href="http://a.com/">http://a.com/</a>')
+
+    def test_escapes_stray_markup_in_text(self):
+        self.assertEqual(linkify(u'1 < 2 && 3 > 2 &amp;'),
+                         u'1 &lt; 2 &amp;&amp; 3 &gt; 2 &amp;')
+
+    def test_keeps_editor_formatting(self):
+        html = (u'<p>A <strong>bold</strong> <em>claim</em><br></p>'
+                u'<ul><li>one</li></ul><table><tr><td colspan="2">c</td></tr></table>')
+        self.assertEqual(linkify(html), html)
+
+    def test_escapes_script(self):
+        self.assertEqual(linkify(u'<script>alert(1)</script>'),
+                         u'&lt;script&gt;alert(1)&lt;/script&gt;')
+        self.assertEqual(linkify(u'<svg/onload=alert(1)>'),
+                         u'&lt;svg/onload=alert(1)&gt;')
+
+    def test_drops_event_handlers(self):
+        self.assertEqual(linkify(u'<img src=x onerror=alert(1)>'), u'<img>')
+        self.assertEqual(linkify(u'<p onclick="alert(1)" style="x">t</p>'), u'<p>t</p>')
+        self.assertEqual(linkify(u'<img src="http://a.com/i.png" onerror="alert(1)"/>'),
+                         u'<img src="http://a.com/i.png">')
+
+    def test_drops_unsafe_hrefs(self):
+        for href in (u'javascript:alert(1)', u' JavaScript:alert(1)',
+                     u'jav&#x61;script:alert(1)', u'data:text/html,x', u'//a.com/'):
+            self.assertEqual(linkify(u'<a href="%s">x</a>' % href), u'<a>x</a>')
+
+    def test_quotes_attribute_values(self):
+        self.assertEqual(linkify(u"<A HREF='https://a.com/?q=\"1\"&amp;r=2' title=t>x</A>"),
+                         u'<a href="https://a.com/?q=&quot;1&quot;&amp;r=2" title="t">x</a>')
+
+    def test_drops_comments(self):
+        self.assertEqual(linkify(u'a<!--[if IE]><script>x</script><![endif]-->b'), u'ab')
+
+
+if __name__ == '__main__':
+    unittest.main()
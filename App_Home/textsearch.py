@@ -0,0 +1,78 @@
+"""
+Tokenizing and ranking for the question full-text search.
+
+Words in alphabetic scripts are lowercased and split on anything that is
+not a letter or digit. Chinese, Japanese and Korean text has no spaces
+between words, so runs of those characters are indexed as overlapping
+two-character terms (a single character on its own is kept as is); a
+query is split the same way, so a phrase matches through its pairs.
+
+Documents are ranked by TF-IDF: each query term found in a document adds
+``(1 + log tf) * log(1 + N / df)``.
+"""
+import re
+import math
+
+MAX_TERM_LENGTH = 40
+
+CJK = (u'\u3040-\u30ff'     # hiragana, katakana
+       u'\u3400-\u4dbf'     # CJK extension A
+       u'\u4e00-\u9fff'     # CJK unified ideographs
+       u'\uac00-\ud7af'     # hangul syllables
+       u'\uf900-\ufaff')    # CJK compatibility ideographs
+
+TOKEN = re.compile(u'([%s]+)|((?:(?![%s])[^\\W_])+)' % (CJK, CJK), re.UNICODE)
+MARKUP = re.compile(r'<[^>]*>|&#?\w+;')
+
+STOPWORDS = frozenset(u'''a an and are as at be but by can do does for from
+how i if in is it my not of on or so that the this to was what when where
+which who why will with you'''.split())
+
+
+def tokenize(text):
+    """
+    Terms of a piece of text (HTML allowed), in order, repeats included.
+    """
+    terms = []
+    for cjk, word in TOKEN.findall(MARKUP.sub(u' ', text or u'')):
+        if cjk:
+            if len(cjk) == 1:
+                terms.append(cjk)
+            else:
+                terms.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+        else:
+            word = word.lower()[:MAX_TERM_LENGTH]
+            if word not in STOPWORDS:
+                terms.append(word)
+    return terms
+
+
+def term_frequencies(*weighted_texts):
+    """
+    { term: weighted count } over (text, weight) pairs, so that e.g. a
+    title can count more than a body.
+    """
+    counts = {}
+    for text, weight in weighted_texts:
+        for term in tokenize(text):
+            counts[term] = counts.get(term, 0) + weight
+    return counts
+
+
+def rank(postings, total_docs):
+    """
+    Rank documents for a query.
+
+    :param postings: { term: { doc: tf } } for the terms of the query
+    :param total_docs: number of indexed documents
+    :return: [(score, doc), ...], best first
+    """
+    scores = {}
+    for term, docs in postings.items():
+        if not docs:
+            continue
+        idf = math.log(1 + float(max(total_docs, len(docs))) / len(docs))
+        for doc, tf in docs.items():
+            scores[doc] = scores.get(doc, 0.0) + (1 + math.log(tf)) * idf
+    return sorted(((score, doc) for doc, score in scores.items()),
+                  key=lambda item: (-item[0], item[1]))
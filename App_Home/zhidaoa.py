@@ -5,19 +5,47 @@ import logging
 import datetime
 import math
 import cgi
+import time
+import random
+import hashlib
+import json
+import base64
+import bisect
+import calendar
 from urlparse import urlparse
 import re
 
 from google.appengine.api import images
 from google.appengine.api import users
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import blobstore
 from google.appengine.ext.webapp import blobstore_handlers
 
 import webapp2
 import jinja2
 
+from linkify import linkify
+import textsearch
+
 MAX_PAGE_LIST = 5
+ANSWER_SORTS = ('votes', 'newest')
+ANSWER_PAGE_SIZE = 10       # answers per page, ?size= can ask for up to
+MAX_ANSWER_PAGE_SIZE = 50   # this many
+EXCERPT_LENGTH = 300
+COUNTER_SHARDS = 20
+TAG_POSTING_SHARDS = 4
+SEARCH_SHARDS = 4
+BATCH_SIZE = 100   # entities per task of the maintenance walks (BatchHandler)
+TITLE_WEIGHT = 3   # a term in the title counts as much as this many in the text
+VOTE_RECONCILE_DELAY = 2   # seconds a burst of votes is batched for
+QUESTION_VIEWS = ('newest', 'hot', 'unanswered')
+FLUSH_INTERVAL = 60   # seconds between the flush_views cron runs (cron.yaml)
+HOT_PERIOD = 45000.0   # seconds of newer activity worth ten times the answers and votes
+ANSWER_WEIGHT = 2      # an answer counts as much as this many up votes towards hot
+PUBLIC_CACHE_TIME = 60 * 5
 
 JINJA_ENVIRONMENT = jinja2.Environment(
     loader = jinja2.FileSystemLoader(os.path.dirname(__file__)))
@@ -38,18 +66,144 @@ class Question(ndb.Model):
     author = ndb.UserProperty()
     title = ndb.StringProperty()
     content = ndb.TextProperty(indexed=False)
+    content_html = ndb.TextProperty(indexed=False)   # render_content(content)
     created_date = ndb.DateTimeProperty(auto_now_add=True)
     modified_date = ndb.DateTimeProperty()
     tags = ndb.StringProperty(repeated=True)
+    # kept by the answer and vote transactions; None on questions stored
+    # before they were, until load_activity fills them in
+    answer_count = ndb.IntegerProperty()
+    vote_total = ndb.IntegerProperty(indexed=False)
+    last_activity = ndb.DateTimeProperty(indexed=False)
+    hot_score = ndb.ComputedProperty(lambda self: question_hot_score(self))
+
+    @classmethod
+    def date_order(cls, reverse=False):
+        """
+        Newest first, with the key as tie breaker so that cursors are stable
+        (and allowed at all on ``tags.IN`` queries). ``reverse`` gives the
+        opposite order, used to page backwards.
+        """
+        if reverse:
+            return [cls.created_date, -cls.key]
+        return [-cls.created_date, cls.key]
+
+    @classmethod
+    def hot_order(cls, reverse=False):
+        if reverse:
+            return [cls.hot_score, -cls.key]
+        return [-cls.hot_score, cls.key]
 
 class Answer(ndb.Model):
     author = ndb.UserProperty()
     content = ndb.TextProperty(indexed=False)
-    vote = ndb.IntegerProperty(indexed=False)
-    voters = ndb.StringProperty(repeated=True)
+    content_html = ndb.TextProperty(indexed=False)   # render_content(content)
+    vote = ndb.IntegerProperty()   # reconciled from the vote counter
+    voters = ndb.StringProperty(repeated=True)  # legacy, emptied by migrate_answer_votes
     created_date = ndb.DateTimeProperty(auto_now_add=True)
     modified_date = ndb.DateTimeProperty()
 
+    @classmethod
+    def page_order(cls, sort):
+        """
+        Order of the answers on a question page: best voted first (newest
+        first among equals), or newest first for ``sort='newest'``.
+        """
+        if sort == 'newest':
+            return [-cls.created_date]
+        return [-cls.vote, -cls.created_date]
+
+class QuestionRedirect(ndb.Model):
+    """
+    Where a question moved by /tasks/migrate_questions lives now. The id
+    is the urlsafe form of its old key.
+    """
+    question = ndb.KeyProperty(indexed=False)
+
+class QuestionSummary(ndb.Model):
+    """
+    What the question list shows of a question, written along with it as
+    a child entity so the list reads these instead of the full questions.
+    """
+    author = ndb.UserProperty(indexed=False)
+    title = ndb.StringProperty(indexed=False)
+    tags = ndb.StringProperty(repeated=True, indexed=False)
+    created_date = ndb.DateTimeProperty(indexed=False)
+    excerpt = ndb.TextProperty()
+    truncated = ndb.BooleanProperty(indexed=False)
+    answer_count = ndb.IntegerProperty(indexed=False)
+    vote_total = ndb.IntegerProperty(indexed=False)
+    last_activity = ndb.DateTimeProperty(indexed=False)
+
+    @property
+    def question_key(self):
+        return self.key.parent()
+
+    @classmethod
+    def summary_key(cls, question_key):
+        return ndb.Key(cls, 'summary', parent=question_key)
+
+    @classmethod
+    def for_question(cls, question):
+        excerpt, truncated = make_excerpt(question.content, EXCERPT_LENGTH)
+        return cls(key=cls.summary_key(question.key), author=question.author,
+                   title=question.title, tags=question.tags,
+                   created_date=question.created_date,
+                   excerpt=excerpt, truncated=truncated,
+                   answer_count=question.answer_count,
+                   vote_total=question.vote_total,
+                   last_activity=question.last_activity)
+
+class Vote(ndb.Model):
+    """
+    One user's vote on an answer, a root entity whose id (see ``vote_id``)
+    makes voting twice a no-op. ``value`` is +1 or -1, or None for the
+    votes carried over from the old voters list, whose sign wasn't kept.
+    """
+    answer = ndb.KeyProperty()
+    value = ndb.IntegerProperty(indexed=False)
+    created_date = ndb.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def vote_id(cls, answer_key, user_id):
+        return '%s:%s' % (answer_key.urlsafe(), user_id)
+
+class TagPostings(ndb.Model):
+    """
+    One of TAG_POSTING_SHARDS shards of the postings of a tag: every
+    question carrying the tag, as [created timestamp, parent id, question
+    id]. Tag searches read the shards of all their tags with one
+    get_multi and combine them in memory.
+    """
+    postings = ndb.JsonProperty(compressed=True)
+
+class SearchPostings(ndb.Model):
+    """
+    One of SEARCH_SHARDS shards of the postings of a search term:
+    { doc id: weighted count of the term } over the questions whose
+    title, body or answers contain it (see ``search_doc_id``).
+    """
+    postings = ndb.JsonProperty(compressed=True)
+
+class SearchDocument(ndb.Model):
+    """
+    The terms a question was last indexed with, under its doc id, so that
+    indexing it again only rewrites the postings that changed.
+    """
+    terms = ndb.JsonProperty(compressed=True)
+
+class ViewCount(ndb.Model):
+    """
+    Views of a question, counted write-behind (see ``record_view``). The
+    id is the question's urlsafe key; a root entity, so flushing never
+    contends with the writes to the question's group.
+    """
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+class CounterShard(ndb.Model):
+    """One of COUNTER_SHARDS shards of a named counter."""
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
 class UserPhoto(ndb.Model):
     author = ndb.UserProperty()
     blob_key = ndb.BlobKeyProperty()
@@ -57,16 +211,633 @@ class UserPhoto(ndb.Model):
     note = ndb.StringProperty()
     created_date = ndb.DateTimeProperty(auto_now_add=True)
 
-def url_repl(m):
-    ext = m.group(1)
-    if ext in ['.png', '.jpg', '.gif']:
-        return "<img src='%s'>" % m.group(0)
+OLD_QUESTIONS_PARENT = ndb.Key("Questions", "0")
+
+def question_parent(user):
+    """
+    Entity group of a user's questions. With one group per author, each
+    group only takes the writes of one person, instead of every question
+    on the site sharing OLD_QUESTIONS_PARENT.
+    """
+    if user is None:
+        return ndb.Key("Questions", "anonymous")
+    return ndb.Key("Questions", user.user_id() or user.email())
+
+def merge_own_questions(summaries, own_keys, page_size):
+    """
+    Add to the first page of a listing the user's own newest questions
+    (from a consistent ancestor query) that the eventually consistent
+    global query does not return yet, so a question shows up for its
+    author as soon as it is posted.
+    """
+    shown = set(summary.question_key for summary in summaries)
+    missing = [key for key in own_keys if key not in shown]
+    if not missing:
+        return summaries
+    extra = get_question_summaries(missing)
+    if len(summaries) >= page_size:
+        oldest = summaries[-1].created_date
+        extra = [summary for summary in extra if summary.created_date > oldest]
+    merged = summaries + extra
+    merged.sort(key=lambda summary: summary.created_date, reverse=True)
+    return merged
+
+def move_question(old_key):
+    """
+    Move one question and the entities stored under it to its author's
+    group, leaving a QuestionRedirect behind. Returns the new key.
+    """
+    question = old_key.get()
+    if question is None:
+        return None
+    parent = question_parent(question.author)
+    new_key = ndb.Key(Question, Question.allocate_ids(1, parent=parent)[0], parent=parent)
+
+    # fresh ids for the children, so ids allocated later under the new
+    # question can't collide with the ones they had under the old one
+    new_keys = {}
+    for child_key in ndb.Query(ancestor=old_key).fetch(keys_only=True):
+        if child_key.parent() != old_key:
+            continue
+        if isinstance(child_key.id(), basestring):
+            child_id = child_key.id()
+        else:
+            incomplete = ndb.Key(child_key.kind(), None, parent=new_key)
+            child_id = ndb.get_context().allocate_ids(incomplete, size=1).get_result()[0]
+        new_keys[child_key] = ndb.Key(child_key.kind(), child_id, parent=new_key)
+    if _move_question_txn(old_key, new_key, new_keys) is None:
+        return None
+
+    # votes are keyed by the answer, so they follow it to its new key
+    for old_child_key, new_child_key in new_keys.items():
+        if old_child_key.kind() == Answer._get_kind():
+            move_answer_votes(old_child_key, new_child_key)
+    return new_key
+
+@ndb.transactional(xg=True)
+def _move_question_txn(old_key, new_key, new_keys):
+    question = old_key.get()
+    if question is None:
+        return None
+    children = [child for child in ndb.Query(ancestor=old_key).fetch()
+                if child.key.parent() == old_key]
+    if any(child.key not in new_keys for child in children):
+        return None   # written to meanwhile: left for the next run
+
+    old_keys = [old_key] + [child.key for child in children]
+    question.key = new_key
+    for child in children:
+        child.key = new_keys[child.key]
+    ndb.put_multi([question] + children +
+                  [QuestionRedirect(id=old_key.urlsafe(), question=new_key)])
+    ndb.delete_multi(old_keys)
+    return new_key
+
+def make_excerpt(content, length):
+    """
+    Plain text teaser of a body: tags dropped, whitespace collapsed and
+    cut at a word boundary. Returns (excerpt, truncated).
+    """
+    text = u' '.join(re.sub(r'<[^>]*>', u' ', content or u'').split())
+    if len(text) <= length:
+        return text, False
+    cut = text.rfind(u' ', 0, length)
+    if cut <= 0:
+        cut = length
+    return text[:cut], True
+
+def get_question_summaries(question_keys):
+    """
+    Summaries of the given questions, in order. Questions written before
+    summaries existed get theirs built and stored on the way.
+    """
+    summaries = ndb.get_multi([QuestionSummary.summary_key(key) for key in question_keys])
+    missing = [key for key, summary in zip(question_keys, summaries) if summary is None]
+    if missing:
+        built = dict((question.key, QuestionSummary.for_question(question))
+                     for question in ndb.get_multi(missing) if question)
+        ndb.put_multi(built.values())
+        summaries = [summary or built.get(key) for key, summary in zip(question_keys, summaries)]
+    return [summary for summary in summaries if summary]
+
+def counter_keys(name):
+    return [ndb.Key(CounterShard, '%s-%d' % (name, i)) for i in range(COUNTER_SHARDS)]
+
+def get_count(name):
+    """Sum the shards of a counter; ndb serves them from memcache mostly."""
+    return sum(shard.count for shard in ndb.get_multi(counter_keys(name)) if shard)
+
+@ndb.transactional
+def increment_counter(name, delta=1):
+    """Add delta to one random shard, so writers rarely contend."""
+    key = ndb.Key(CounterShard, '%s-%d' % (name, random.randint(0, COUNTER_SHARDS - 1)))
+    shard = key.get() or CounterShard(key=key)
+    shard.count += delta
+    shard.put()
+
+def count_questions():
+    """Number of stored questions, from the maintained counter."""
+    return get_count('questions')
+
+def question_hot_score(question):
+    """
+    Rank of a question in the hot view: log10 of how much it was answered
+    and voted on, plus its last activity time in HOT_PERIODs. Newer
+    activity outweighs older activity ten times as large, and scores
+    never need to decay, so they only change when the question does.
+    """
+    last = question.last_activity or question.created_date or datetime.datetime.utcnow()
+    weight = 1 + ANSWER_WEIGHT * (question.answer_count or 0) + max(question.vote_total or 0, 0)
+    return math.log10(weight) + calendar.timegm(last.utctimetuple()) / HOT_PERIOD
+
+def new_question_activity(question):
+    question.answer_count = 0
+    question.vote_total = 0
+    question.last_activity = question.modified_date or question.created_date
+
+def refresh_activity(question):
+    """Recompute the activity fields of a question from its answers."""
+    answers = Answer.query(ancestor=question.key).fetch()
+    question.answer_count = len(answers)
+    question.vote_total = sum(answer.vote or 0 for answer in answers)
+    question.last_activity = max(
+        [question.modified_date or question.created_date] +
+        [answer.modified_date or answer.created_date for answer in answers])
+
+def get_activity(question_key):
+    """
+    The question, with its activity fields filled in if it was stored
+    before they were kept. Call inside a transaction on its group.
+    """
+    question = question_key.get()
+    if question and (question.answer_count is None or question.vote_total is None
+                     or question.last_activity is None):
+        refresh_activity(question)
+    return question
+
+def put_question(question, *entities):
+    """Put a question with its summary, and any other entities given."""
+    ndb.put_multi([question, QuestionSummary.for_question(question)] + list(entities))
+
+@ndb.transactional
+def add_answer(answer):
+    """
+    Put a new answer and count it on its question, in one transaction of
+    the question's entity group.
+    """
+    question = get_activity(answer.key.parent())
+    question.answer_count += 1
+    question.vote_total += answer.vote or 0
+    question.last_activity = datetime.datetime.utcnow()
+    put_question(question, answer)
+
+@ndb.transactional
+def save_question_edit(question):
+    """
+    Put an edited question, keeping the activity fields it has in the
+    datastore (an answer or vote may have changed them since it was read).
+    """
+    stored = get_activity(question.key)
+    question.answer_count = stored.answer_count
+    question.vote_total = stored.vote_total
+    question.last_activity = max(stored.last_activity, question.modified_date)
+    put_question(question)
+
+@ndb.transactional
+def update_answer(answer):
+    """Put an edited answer, marking its question active."""
+    question = get_activity(answer.key.parent())
+    question.last_activity = answer.modified_date
+    put_question(question, answer)
+
+@ndb.transactional
+def remove_answer(answer_key):
+    question = get_activity(answer_key.parent())
+    answer = answer_key.get()
+    answer_key.delete()
+    if question and answer:
+        question.answer_count -= 1
+        question.vote_total -= answer.vote or 0
+        put_question(question)
+
+@ndb.transactional
+def load_activity(question_key):
+    """
+    Fill in and store the activity fields of a question stored before
+    they were kept.
+    """
+    question = get_activity(question_key)
+    if question:
+        put_question(question)
+    return question
+
+@ndb.transactional
+def reload_activity(question_key):
+    """Recompute and store the activity fields of a question from scratch."""
+    question = question_key.get()
+    if question:
+        refresh_activity(question)
+        put_question(question)
+    return question
+
+def vote_counter(answer_key):
+    return 'votes:' + answer_key.urlsafe()
+
+@ndb.transactional(xg=True)
+def cast_vote(answer_key, user_id, value):
+    """
+    Record a user's vote on an answer and add it to the answer's sharded
+    vote counter. Returns False when the user had already voted.
+    """
+    key = ndb.Key(Vote, Vote.vote_id(answer_key, user_id))
+    if key.get():
+        return False
+    Vote(key=key, answer=answer_key, value=value).put()
+    increment_counter(vote_counter(answer_key), value)
+    return True
+
+def schedule_vote_reconcile(answer_key):
+    """
+    Queue one reconcile task per answer for a burst of votes: the memcache
+    flag is cleared by the task before it reads the counter, so a vote
+    arriving after that queues the next one.
+    """
+    if memcache.add('reconcile:' + answer_key.urlsafe(), 1, time=60):
+        taskqueue.add(url='/tasks/reconcile_votes',
+                      params={'aid': answer_key.urlsafe()},
+                      countdown=VOTE_RECONCILE_DELAY)
+
+@ndb.transactional
+def set_answer_vote(answer_key, total):
+    """
+    Store an answer's reconciled vote total, and move its question's
+    vote_total by the difference in the same transaction.
+    """
+    question = get_activity(answer_key.parent())
+    answer = answer_key.get()
+    if answer is None or answer.vote == total:
+        return False
+    if question:
+        question.vote_total += total - (answer.vote or 0)
+        put_question(question)
+    answer.vote = total
+    answer.put()
+    return True
+
+@ndb.transactional
+def reindex_answer(answer_key):
+    # in a transaction, so a concurrent reconcile's vote isn't overwritten
+    answer = answer_key.get()
+    if answer:
+        if answer.vote is None:
+            answer.vote = 0
+        answer.put()
+
+def migrate_answer_votes(answer):
+    """
+    Turn the legacy voters list of an answer into Vote entities and seed
+    its vote counter with the stored total.
+    """
+    ndb.put_multi([Vote(id=Vote.vote_id(answer.key, voter), answer=answer.key)
+                   for voter in answer.voters])
+    _migrate_answer_votes_txn(answer.key)
+
+@ndb.transactional(xg=True)
+def _migrate_answer_votes_txn(answer_key):
+    answer = answer_key.get()
+    if answer is None or not answer.voters:
+        return
+    keys = counter_keys(vote_counter(answer_key))
+    ndb.delete_multi(keys[1:])
+    CounterShard(key=keys[0], count=answer.vote or 0).put()
+    answer.voters = []
+    answer.put()
+
+def move_answer_votes(old_key, new_key):
+    """
+    Carry the votes of a moved answer over to its new key: the Vote
+    entities that stop a user voting twice, and the vote counter, whose
+    total then goes back into Answer.vote through a reconcile. An answer
+    still on the old voters list has no counter yet, and keeps its vote.
+    """
+    votes = Vote.query(Vote.answer == old_key).fetch()
+    ndb.put_multi([Vote(id=Vote.vote_id(new_key, vote.key.id().split(':', 1)[1]),
+                        answer=new_key, value=vote.value, created_date=vote.created_date)
+                   for vote in votes])
+    counted = _move_counter_txn(vote_counter(old_key), vote_counter(new_key))
+    ndb.delete_multi([vote.key for vote in votes])
+    if counted:
+        schedule_vote_reconcile(new_key)
+
+@ndb.transactional(xg=True)
+def _move_counter_txn(old_name, new_name):
+    # COUNTER_SHARDS + 1 entity groups, within the limit of an XG transaction
+    old_keys = counter_keys(old_name)
+    shards = [shard for shard in ndb.get_multi(old_keys) if shard]
+    if not shards:
+        return False
+    key = counter_keys(new_name)[0]
+    shard = key.get() or CounterShard(key=key)
+    shard.count += sum(old.count for old in shards)
+    shard.put()
+    ndb.delete_multi(old_keys)
+    return True
+
+def posting_entry(question_key, created_date):
+    timestamp = calendar.timegm(created_date.utctimetuple()) + created_date.microsecond / 1e6
+    return [timestamp, question_key.parent().id(), question_key.id()]
+
+def posting_question_key(entry):
+    return ndb.Key('Questions', entry[1], Question, entry[2])
+
+def posting_keys(tag):
+    return [ndb.Key(TagPostings, '%s#%d' % (tag, i)) for i in range(TAG_POSTING_SHARDS)]
+
+def posting_tags(tags):
+    return set(tag.strip() for tag in tags or [] if tag.strip())
+
+@ndb.transactional
+def change_posting(key, entry, add):
+    shard = key.get() or TagPostings(key=key, postings=[])
+    if entry in shard.postings:
+        if add:
+            return
+        shard.postings.remove(entry)
+    elif add:
+        shard.postings.append(entry)
+    else:
+        return
+    shard.put()
+
+def update_tag_postings(question_key, created_date, old_tags, new_tags):
+    """
+    Keep the tag postings in step with a write: old_tags is None for a new
+    question, new_tags is None for a deleted one.
+    """
+    entry = posting_entry(question_key, created_date)
+    shard = question_key.id() % TAG_POSTING_SHARDS
+    old_tags = posting_tags(old_tags)
+    new_tags = posting_tags(new_tags)
+    for tag in old_tags - new_tags:
+        change_posting(posting_keys(tag)[shard], entry, False)
+    for tag in new_tags - old_tags:
+        change_posting(posting_keys(tag)[shard], entry, True)
+
+def search_tag_postings(tags, match_all):
+    """
+    Postings of the questions carrying all (match_all) or any of the tags,
+    newest first, from one batched read whatever the number of tags.
+    """
+    tags = sorted(posting_tags(tags))
+    if not tags:
+        return []
+    shards = ndb.get_multi([key for tag in tags for key in posting_keys(tag)])
+    sets = []
+    for i in range(len(tags)):
+        entries = set()
+        for shard in shards[i * TAG_POSTING_SHARDS:(i + 1) * TAG_POSTING_SHARDS]:
+            if shard:
+                entries.update(tuple(entry) for entry in shard.postings)
+        sets.append(entries)
+    if match_all:
+        found = set.intersection(*sets)
+    else:
+        found = set.union(*sets)
+    return sorted(found, key=posting_order)
+
+def posting_order(entry):
+    return (-entry[0], entry[1], entry[2])
+
+def encode_posting(entry):
+    return base64.urlsafe_b64encode(json.dumps(entry))
+
+def decode_posting(cursor):
+    return tuple(json.loads(base64.urlsafe_b64decode(cursor.encode('ascii'))))
+
+def search_doc_id(question_key):
+    return u'%s:%s' % (question_key.parent().id(), question_key.id())
+
+def search_doc_question_key(doc_id):
+    parent, question_id = doc_id.rsplit(u':', 1)
+    return ndb.Key('Questions', parent, Question, int(question_id))
+
+def search_posting_key(term, shard):
+    return ndb.Key(SearchPostings, u'%s#%d' % (term, shard))
+
+def question_terms(question, answers):
+    return textsearch.term_frequencies(
+        *[(question.title, TITLE_WEIGHT), (question.content, 1)] +
+         [(answer.content, 1) for answer in answers])
+
+@ndb.transactional_tasklet
+def set_search_posting(key, doc_id, count):
+    """Set (or, with count None, remove) one document in a postings shard."""
+    shard = yield key.get_async()
+    postings = shard.postings if shard else {}
+    if postings.get(doc_id) == count:
+        return
+    if count is None:
+        del postings[doc_id]
+    else:
+        postings[doc_id] = count
+    if postings:
+        yield SearchPostings(key=key, postings=postings).put_async()
+    else:
+        yield key.delete_async()
+
+def index_question(question_key, rebuild=False):
+    """
+    Bring the search index in line with a question's title, body and
+    answers, or take the question out of it once it is deleted. Only the
+    terms that changed since the stored SearchDocument are written,
+    unless rebuild asks to check every posting of the question.
+    """
+    doc_id = search_doc_id(question_key)
+    question, document = ndb.get_multi([question_key, ndb.Key(SearchDocument, doc_id)])
+    if question:
+        terms = question_terms(question, Answer.query(ancestor=question_key))
+    else:
+        terms = {}
+    old_terms = document.terms if document else {}
+
+    shard = question_key.id() % SEARCH_SHARDS
+    futures = [set_search_posting(search_posting_key(term, shard), doc_id, terms.get(term))
+               for term in set(old_terms) | set(terms)
+               if rebuild or old_terms.get(term) != terms.get(term)]
+    for future in futures:
+        future.get_result()
+
+    if terms:
+        SearchDocument(id=doc_id, terms=terms).put()
+    elif document:
+        document.key.delete()
+
+def search_index_task(question_key, rebuild=False):
+    params = {'qid': question_key.urlsafe()}
+    if rebuild:
+        params['rebuild'] = '1'
+    return taskqueue.Task(url='/tasks/index_question', params=params)
+
+def queue_search_index(*question_keys):
+    if question_keys:
+        taskqueue.Queue().add([search_index_task(key) for key in question_keys])
+
+def search_questions(query):
+    """
+    Keys of the questions matching a full-text query, best first, from one
+    batched read of the postings of the query's terms.
+    """
+    terms = sorted(set(textsearch.tokenize(query)))
+    if not terms:
+        return []
+    shards = ndb.get_multi([search_posting_key(term, shard)
+                            for term in terms for shard in range(SEARCH_SHARDS)])
+    postings = {}
+    for i, term in enumerate(terms):
+        docs = postings[term] = {}
+        for shard in shards[i * SEARCH_SHARDS:(i + 1) * SEARCH_SHARDS]:
+            if shard:
+                docs.update(shard.postings)
+    return [search_doc_question_key(doc_id)
+            for score, doc_id in textsearch.rank(postings, count_questions())]
+
+def view_key(question_key):
+    return ndb.Key(ViewCount, question_key.urlsafe())
+
+def record_view(question_key):
+    """
+    Count a view of a question in memcache only; flush_views moves the
+    deltas to the datastore in batches. A delta evicted before that is
+    lost, which undercounts by at most one flush interval of views.
+    """
+    view_id = question_key.urlsafe()
+    memcache.incr('views:' + view_id, initial_value=0)
+    # only the first view since the last flush touches the dirty list;
+    # the mark expires in case the list is evicted without it
+    if memcache.add('views_marked:' + view_id, 1, time=3 * FLUSH_INTERVAL):
+        mark_views_dirty(view_id)
+
+def mark_views_dirty(view_id):
+    client = memcache.Client()
+    for i in range(10):
+        dirty = client.gets('views_dirty')
+        if dirty is None:
+            if client.add('views_dirty', [view_id]):
+                return
+        elif client.cas('views_dirty', dirty + [view_id]):
+            return
+    # let the next view try again
+    memcache.delete('views_marked:' + view_id)
+
+@ndb.tasklet
+def get_views_async(question_key):
+    """Views of a question: the stored count plus the delta not flushed yet."""
+    stored, delta = yield (view_key(question_key).get_async(),
+                           ndb.get_context().memcache_get('views:' + question_key.urlsafe()))
+    raise ndb.Return((stored.count if stored else 0) + int(delta or 0))
+
+def flush_views():
+    """
+    Add the buffered view deltas of the dirty questions to their counts.
+    Returns the number of counts written.
+    """
+    client = memcache.Client()
+    for i in range(10):
+        view_ids = client.gets('views_dirty')
+        if not view_ids or client.cas('views_dirty', []):
+            break
+    else:
+        return 0
+    if not view_ids:
+        return 0
+
+    # unmark first: a view from here on lists its question again, and
+    # whatever part of its delta this flush reads is taken off below
+    view_ids = list(set(view_ids))
+    memcache.delete_multi(view_ids, key_prefix='views_marked:')
+    deltas = dict((view_id, int(delta)) for view_id, delta in
+                  memcache.get_multi(view_ids, key_prefix='views:').items() if delta)
+
+    question_keys = [ndb.Key(urlsafe=view_id) for view_id in deltas]
+    question_keys = [key for key in question_keys if key.kind() == Question._get_kind()]
+    view_keys = [view_key(key) for key in question_keys]
+    counts = []
+    for key, question, count in zip(view_keys, ndb.get_multi(question_keys), ndb.get_multi(view_keys)):
+        if question is None:
+            continue   # views of a deleted question, or of an id made up
+        count = count or ViewCount(key=key)
+        count.count += deltas[key.id()]
+        counts.append(count)
+    ndb.put_multi(counts)
+
+    memcache.offset_multi(dict((view_id, -delta) for view_id, delta in deltas.items()),
+                          key_prefix='views:')
+    return len(counts)
+
+def get_generation():
+    """
+    Time of the last write to the questions and answers, as a float
+    timestamp. The HTTP validators of the Q&A pages are derived from it.
+    """
+    generation = memcache.get('qa_generation')
+    if generation is None:
+        # A generation lost to eviction restarts at the current time, newer
+        # than anything cached before, so stale copies are never reused.
+        memcache.add('qa_generation', time.time())
+        generation = memcache.get('qa_generation')
+    return generation or time.time()
+
+def bump_generation():
+    """Record a write to the questions or answers."""
+    client = memcache.Client()
+    for i in range(10):
+        current = client.gets('qa_generation')
+        # never move backwards, even with clock skew between instances
+        generation = max(time.time(), (current or 0) + 0.001)
+        if current is None:
+            if client.add('qa_generation', generation):
+                return
+        elif client.cas('qa_generation', generation):
+            return
+    client.set('qa_generation', time.time())
+
+def not_modified(handler, generation):
+    """
+    Set the validators and caching headers of handler's response from the
+    content generation, and answer 304 Not Modified when the client's copy
+    is still current. Returns True when nothing is left to render.
+    """
+    user = users.get_current_user()
+    last_modified = datetime.datetime.utcfromtimestamp(int(generation))
+    handler.response.etag = hashlib.md5('%r|%s|%s' % (
+        generation, handler.request.path_qs,
+        user.user_id() if user else '')).hexdigest()
+    handler.response.last_modified = last_modified
+
+    if user:
+        handler.response.headers['Cache-Control'] = 'private, max-age=0'
     else:
-        return "<a href='%s'>%s</a>" % (m.group(0), m.group(0))
+        # anonymous pages are the same for everyone: let the edge cache them
+        handler.response.headers['Cache-Control'] = 'public, max-age=%d' % PUBLIC_CACHE_TIME
+        handler.response.headers['Vary'] = 'Cookie'
+
+    if handler.request.if_none_match:
+        current = handler.response.etag in handler.request.if_none_match
+    elif handler.request.if_modified_since:
+        current = last_modified <= handler.request.if_modified_since.replace(tzinfo=None)
+    else:
+        current = False
 
-def parse_content(content):
+    if current:
+        handler.response.set_status(304)
+    return current
 
-    return re.sub(r'[a-zA-Z0-9]+://(?:[a-zA-Z0-9_]+:[a-zA-Z0-9_]+@)?(?:[a-zA-Z0-9.-]+\.[A-Za-z]{2,4})(?::[0-9]+)?(?:/[^ \.]*)?(\.[^\s]*)?', url_repl, content)
+def render_content(content):
+    """
+    HTML shown for a question or answer body, computed once when the body
+    is saved and stored as ``content_html``: see ``linkify``.
+    """
+    return linkify(content)
 
 
 class HomePageHandler(webapp2.RequestHandler):
@@ -131,11 +902,111 @@ class QuestionHomeHandler(webapp2.RequestHandler):
 
         return PageCount
 
+    def fetch_page(self, query_for, page, max_page_size):
+        """
+        Fetch one page of the listing built by ``query_for(reverse)``.
+
+        ``cursor`` in the URL pages forward from an opaque datastore cursor,
+        ``before`` pages backward to one; a bare ``page`` number (a direct
+        jump from the page list) falls back to an offset. The query is keys
+        only and the page is filled from the ``QuestionSummary`` entities.
+
+        :return: (summaries, prev_cursor, next_cursor), cursors urlsafe or None
+        """
+        cursor = self.request.get('cursor')
+        before = self.request.get('before')
+
+        if before:
+            end = Cursor(urlsafe=before)
+            keys, start, more = query_for(True).fetch_page(
+                max_page_size, start_cursor=end.reversed(), keys_only=True)
+            keys.reverse()
+            if more and start:
+                prev_cursor = start.reversed().urlsafe()
+            else:
+                prev_cursor = None
+            return get_question_summaries(keys), prev_cursor, before
+
+        if cursor:
+            keys, end, more = query_for(False).fetch_page(
+                max_page_size, start_cursor=Cursor(urlsafe=cursor), keys_only=True)
+            prev_cursor = cursor
+        else:
+            keys, end, more = query_for(False).fetch_page(
+                max_page_size, offset=page * max_page_size, keys_only=True)
+            prev_cursor = None
+
+        if more and end:
+            next_cursor = end.urlsafe()
+        else:
+            next_cursor = None
+        return get_question_summaries(keys), prev_cursor, next_cursor
+
+    def page_url(self, i):
+        """
+        Link to page ``i`` of the current listing. The neighbouring pages
+        are reached by cursor; only jumps further away use an offset.
+        """
+        params = []
+        if self.search:
+            params.append(('q', self.search.encode('utf-8')))
+        if self.tagstr:
+            params.append(('tag', self.tagstr.encode('utf-8')))
+
+        if i == self.page + 1 and self.next_cursor:
+            params += [('page', i), ('cursor', self.next_cursor)]
+        elif i == self.page - 1 and i > 0 and self.prev_cursor:
+            params += [('page', i), ('before', self.prev_cursor)]
+        elif i > 0:
+            params.append(('page', i))
+
+        if self.match_all:
+            params.append(('match', 'all'))
+        if self.view != 'newest':
+            params.append(('view', self.view))
+
+        if params:
+            return '/Question_Home?' + urllib.urlencode(params)
+        return '/Question_Home'
+
+    def page_of_postings(self, entries, page, max_page_size):
+        """
+        One page of a tag search, with the same ``cursor``, ``before`` and
+        ``page`` parameters as ``fetch_page``. The cursors are positions
+        in the ordered postings.
+
+        :return: (summaries, prev_cursor, next_cursor)
+        """
+        cursor = self.request.get('cursor')
+        before = self.request.get('before')
+        order = [posting_order(entry) for entry in entries]
+
+        if before:
+            end = bisect.bisect_left(order, posting_order(decode_posting(before)))
+            start = max(0, end - max_page_size)
+        else:
+            if cursor:
+                start = bisect.bisect_right(order, posting_order(decode_posting(cursor)))
+            else:
+                start = page * max_page_size
+            end = start + max_page_size
+
+        page_entries = entries[start:end]
+        prev_cursor = encode_posting(page_entries[0]) if page_entries and start > 0 else None
+        next_cursor = encode_posting(page_entries[-1]) if page_entries and end < len(entries) else None
+        summaries = get_question_summaries([posting_question_key(entry) for entry in page_entries])
+        return summaries, prev_cursor, next_cursor
+
     def preprocess(self, cls, f = ''):
         user = users.get_current_user()
         max_page_size = 5
 
         tag = self.request.get('tag').split(' ')
+        match_all = self.request.get('match') == 'all'
+        search = self.request.get('q').strip()
+        view = self.request.get('view')
+        if view not in QUESTION_VIEWS:
+            view = 'newest'
         page = self.request.get('page')
 
         if not page:
@@ -145,15 +1016,53 @@ class QuestionHomeHandler(webapp2.RequestHandler):
 
         func = getattr(cls, f)  # use this to replace cls.query, introduce more flexibility
 
-        if tag[0] != '':
-            question_query = func().filter(cls.tags.IN(tag)).order(-cls.created_date)
+        if search:
+            # ranked by relevance, so paged by number only
+            keys = search_questions(search)
+            total = len(keys)
+            questions = get_question_summaries(keys[page * max_page_size:(page + 1) * max_page_size])
+            prev_cursor = next_cursor = None
+        elif tag[0] != '':
+            # tag searches come from the postings, which are written in
+            # transactions and read by key, so they are already consistent
+            entries = search_tag_postings(tag, match_all)
+            total = len(entries)
+            questions, prev_cursor, next_cursor = self.page_of_postings(entries, page, max_page_size)
         else:
-            question_query = func().order(-cls.created_date)
-            #ancestor=ndb.Key("Questions", "0")
-
-        num_of_page = int(math.ceil(question_query.count() / float(max_page_size)))
-
-        questions = question_query.fetch(max_page_size, offset=page * max_page_size)
+            # each view is a single ordered query on fields kept up to
+            # date on the questions themselves
+            if view == 'hot':
+                query_for = lambda reverse: func().order(*cls.hot_order(reverse))
+                total = count_questions()
+            elif view == 'unanswered':
+                query_for = lambda reverse: func().filter(cls.answer_count == 0).order(*cls.date_order(reverse))
+                total = None
+            else:
+                query_for = lambda reverse: func().order(*cls.date_order(reverse))
+                total = count_questions()
+
+            # the user's own new questions are newest and unanswered, so
+            # they belong on the first page of those two views
+            first_page = (view != 'hot' and page == 0 and not self.request.get('cursor')
+                          and not self.request.get('before'))
+            if user and first_page:
+                own_future = cls.query(ancestor=question_parent(user)).order(
+                    -cls.created_date).fetch_async(max_page_size, keys_only=True)
+
+            questions, prev_cursor, next_cursor = self.fetch_page(query_for, page, max_page_size)
+
+            if user and first_page:
+                questions = merge_own_questions(questions, own_future.get_result(), max_page_size)
+            if view == 'unanswered':
+                # the summaries are read by key, so they also catch
+                # questions answered since the index was last updated
+                questions = [question for question in questions if not question.answer_count]
+
+        if total is not None:
+            num_of_page = int(math.ceil(total / float(max_page_size)))
+        else:
+            # all we know without a counter is whether a next page exists
+            num_of_page = page + (2 if next_cursor else 1)
 
         tagstr = " ".join(tag)
 
@@ -171,7 +1080,12 @@ class QuestionHomeHandler(webapp2.RequestHandler):
         self.page = page
         self.tag = tag
         self.tagstr = tagstr
+        self.search = search
+        self.view = view
+        self.match_all = match_all
         self.questions = questions
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
         self.num_of_page = num_of_page
         self.PageCount = PageCount
         self.user_url = user_url
@@ -179,14 +1093,19 @@ class QuestionHomeHandler(webapp2.RequestHandler):
 
     def get(self):
 
+        if not_modified(self, get_generation()):
+            return
+
         self.preprocess(Question, 'query')
 
         template_values = {
-            'parse_content':parse_content,
             'num_of_page': self.num_of_page,
             'PageCount':self.PageCount,
+            'page_url':self.page_url,
             'tag' : self.tag,
             'tagstr' : self.tagstr,
+            'search': self.search,
+            'view': self.view,
             'page': self.page,
             'user': self.user,
             #'userinfo':userinfo,
@@ -200,11 +1119,49 @@ class QuestionHomeHandler(webapp2.RequestHandler):
 
 class QuestionPageHandler(webapp2.RequestHandler):
     def get(self):
-        user = users.get_current_user()
         question_key = ndb.Key(urlsafe=self.request.get('qid'))
-        question = question_key.get()
+        # counted before the 304 check: a revalidated copy is a view too
+        record_view(question_key)
+        if not_modified(self, get_generation()):
+            return
 
-        answers = Answer.query(ancestor=question_key).order(-Answer.created_date)
+        user = users.get_current_user()
+        size = self.request.get('size')
+        if size.isdigit():
+            size = min(max(int(size), 1), MAX_ANSWER_PAGE_SIZE)
+        else:
+            size = ANSWER_PAGE_SIZE
+        cursor = self.request.get('cursor')
+        sort = self.request.get('sort')
+        if sort not in ANSWER_SORTS:
+            sort = ANSWER_SORTS[0]
+
+        # the question and one page of its answers, read in parallel
+        question_future = question_key.get_async()
+        views_future = get_views_async(question_key)
+        answers_future = Answer.query(ancestor=question_key).order(
+            *Answer.page_order(sort)).fetch_page_async(
+                size, start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+
+        question = question_future.get_result()
+        if question is None:
+            moved = QuestionRedirect.get_by_id(question_key.urlsafe())
+            if moved:
+                self.redirect('/Question?qid=' + moved.question.urlsafe(), permanent=True)
+                return
+        elif question.last_activity is None or question.vote_total is None:
+            question = load_activity(question_key)
+
+        answers, next_cursor, more = answers_future.get_result()
+        if more and next_cursor:
+            next_params = {'qid': question_key.urlsafe(), 'cursor': next_cursor.urlsafe()}
+            if size != ANSWER_PAGE_SIZE:
+                next_params['size'] = size
+            if sort != ANSWER_SORTS[0]:
+                next_params['sort'] = sort
+            next_url = '/Question?' + urllib.urlencode(next_params)
+        else:
+            next_url = None
 
         if user:
             user_url = users.create_logout_url(self.request.uri)
@@ -214,10 +1171,13 @@ class QuestionPageHandler(webapp2.RequestHandler):
             user_url_linktext = 'Login'
 
         template_values = {
-            'parse_content':parse_content,
             'user': user,
             'question': question,
             'answers': answers,
+            'first_answers': not cursor,
+            'views': views_future.get_result(),
+            'sort': sort,
+            'next_url': next_url,
             'user_url':user_url,
             'user_url_linktext':user_url_linktext
         }
@@ -231,13 +1191,23 @@ class AddQuestion(webapp2.RequestHandler):
         user = users.get_current_user()
 
         if user:
-            question = Question(author=user, parent=ndb.Key("Questions", "0"))
+            # the id is allocated up front so the summary can be put with it
+            parent = question_parent(user)
+            question = Question(id=Question.allocate_ids(1, parent=parent)[0],
+                                author=user, parent=parent)
             question.title = self.request.get('title')
             question.content = self.request.get('content')
+            question.content_html = render_content(question.content)
+            question.created_date = datetime.datetime.utcnow()
             q_tags = self.request.get('tags').split(r',')
             question.tags = q_tags
+            new_question_activity(question)
 
-            question.put()
+            put_question(question)
+            increment_counter('questions', 1)
+            update_tag_postings(question.key, question.created_date, None, question.tags)
+            queue_search_index(question.key)
+            bump_generation()
 
         else:
             self.redirect(users.create_login_url())
@@ -254,13 +1224,17 @@ class EditQuestion(webapp2.RequestHandler):
             question = ndb.Key(urlsafe=self.request.get('qid')).get()
             decision = self.request.get('decision')
             if decision == 'Yes':
-                question.key.delete()
+                ndb.delete_multi([question.key, QuestionSummary.summary_key(question.key),
+                                  view_key(question.key)])
+                increment_counter('questions', -1)
+                update_tag_postings(question.key, question.created_date, question.tags, None)
+                queue_search_index(question.key)
+                bump_generation()
                 self.redirect('/DeleteSuccess')
                 return
 
             template_values = {
-                'parse_content':parse_content,
-                'question': question,
+                    'question': question,
                 'user_url':user_url,
                 'user_url_linktext':user_url_linktext
             }
@@ -280,12 +1254,17 @@ class EditQuestion(webapp2.RequestHandler):
 
             question.title = self.request.get('title')
             question.content = self.request.get('content')
-            question.modified_date = datetime.datetime.now()
+            question.content_html = render_content(question.content)
+            question.modified_date = datetime.datetime.utcnow()
 
+            old_tags = question.tags
             q_tags = self.request.get('tags').split(r',')
             question.tags = q_tags
 
-            question.put()
+            save_question_edit(question)
+            update_tag_postings(question.key, question.created_date, old_tags, question.tags)
+            queue_search_index(question.key)
+            bump_generation()
 
             self.redirect('/Question?qid='+question.key.urlsafe())
 
@@ -299,11 +1278,19 @@ class EditAnswerHandler(webapp2.RequestHandler):
         if user:
             user_url = users.create_logout_url(self.request.uri)
             user_url_linktext = 'Logout'
-            answer = ndb.Key(urlsafe=self.request.get('aid')).get()  #not get Key, get the entity itself!
-            question = ndb.Key(urlsafe=self.request.get('qid')).get()
+            # one batched read for both entities, not get Key, get the entities themselves!
+            answer, question = ndb.get_multi_async([
+                ndb.Key(urlsafe=self.request.get('aid')),
+                ndb.Key(urlsafe=self.request.get('qid'))])
+            answer = answer.get_result()
+            question = question.get_result()
             decision = self.request.get('decision')
             if decision == 'Yes':
-                answer.key.delete()
+                remove_answer(answer.key)
+                votes = Vote.query(Vote.answer == answer.key).fetch(keys_only=True)
+                ndb.delete_multi(votes + counter_keys(vote_counter(answer.key)))
+                queue_search_index(question.key)
+                bump_generation()
                 self.redirect('/Question?qid='+question.key.urlsafe())
                 return
 
@@ -323,15 +1310,21 @@ class EditAnswerHandler(webapp2.RequestHandler):
     def post(self):
         user = users.get_current_user()
 
-        answer = ndb.Key(urlsafe=self.request.get('aid')).get()
-        question = ndb.Key(urlsafe=self.request.get('qid')).get()
+        answer, question = ndb.get_multi_async([
+            ndb.Key(urlsafe=self.request.get('aid')),
+            ndb.Key(urlsafe=self.request.get('qid'))])
+        answer = answer.get_result()
+        question = question.get_result()
 
         if user:
 
             answer.content = self.request.get('content')
-            answer.modified_date = datetime.datetime.now()
+            answer.content_html = render_content(answer.content)
+            answer.modified_date = datetime.datetime.utcnow()
 
-            answer.put()
+            update_answer(answer)
+            queue_search_index(question.key)
+            bump_generation()
 
             self.redirect('/Question?qid='+ question.key.urlsafe())
 
@@ -347,38 +1340,300 @@ class AnswerHandler(webapp2.RequestHandler):
         if user:
             answer = Answer(author=user, parent=question_key)
             answer.content = self.request.get('content')
+            answer.content_html = render_content(answer.content)
             answer.vote = 0
-            answer.voters = []
-            answer.put()
+            add_answer(answer)
+            queue_search_index(question_key)
+            bump_generation()
             self.redirect("/Question?qid="+self.request.get('qid'))
         else:
             self.redirect(users.create_login_url)
 
 class UpVoteHandler(webapp2.RequestHandler):
+    """
+    Votes an answer up. The vote only touches the user's Vote entity and
+    a counter shard; the answer's score is updated by the reconcile task.
+    """
+    value = 1
+
     def get(self):
         user = users.get_current_user()
-        answer = ndb.Key(urlsafe = self.request.get('aid')).get()
-        id = user.user_id() + ''
+        if not user:
+            self.redirect(users.create_login_url(self.request.uri))
+            return
 
-        if user and  id not in answer.voters:
-            answer.vote += 1
-            answer.voters.append(id)
-            answer.put()
+        answer = ndb.Key(urlsafe = self.request.get('aid')).get()
+        if answer:
+            if answer.voters:
+                migrate_answer_votes(answer)
+            if cast_vote(answer.key, user.user_id(), self.value):
+                schedule_vote_reconcile(answer.key)
 
         self.redirect("/Question?qid="+self.request.get('qid'))
 
-class DownVoteHandler(webapp2.RequestHandler):
+class DownVoteHandler(UpVoteHandler):
+    value = -1
+
+class ReconcileVotesHandler(webapp2.RequestHandler):
+    """
+    Task copying an answer's vote counter total into ``Answer.vote``.
+    """
+    def post(self):
+        answer_key = ndb.Key(urlsafe=self.request.get('aid'))
+        memcache.delete('reconcile:' + answer_key.urlsafe())
+        if set_answer_vote(answer_key, get_count(vote_counter(answer_key))):
+            bump_generation()
+
+class BatchHandler(webapp2.RequestHandler):
+    """
+    Base of the maintenance tasks that walk every result of a query. A GET
+    (run by hand) queues the first batch; each batch task handles
+    batch_size results from its cursor and queues the next one, so no
+    request has to get through the whole table before its deadline, and
+    a failed batch is retried on its own. The other parameters of the GET
+    are passed along to every batch.
+    """
+    batch_size = BATCH_SIZE
+    keys_only = False
+
+    def query(self):
+        raise NotImplementedError
+
+    def handle_batch(self, results):
+        raise NotImplementedError
+
+    def finished(self):
+        pass
+
     def get(self):
-        user = users.get_current_user()
-        answer = ndb.Key(urlsafe = self.request.get('aid')).get()
-        id = user.user_id() + ''
+        self.queue_batch(None)
+        self.response.write('%s queued' % self.request.path)
 
-        if user and  id not in answer.voters:
-            answer.vote -= 1
-            answer.voters.append(id)
-            answer.put()
+    def post(self):
+        cursor = self.request.get('cursor')
+        results, cursor, more = self.query().fetch_page(
+            self.batch_size, start_cursor=Cursor(urlsafe=cursor) if cursor else None,
+            keys_only=self.keys_only)
+        self.handle_batch(results)
+        if more and cursor:
+            self.queue_batch(cursor)
+        else:
+            self.finished()
+
+    def queue_batch(self, cursor):
+        params = dict((name, value) for name, value in self.request.params.items()
+                      if name != 'cursor')
+        if cursor:
+            params['cursor'] = cursor.urlsafe()
+        taskqueue.add(url=self.request.path, params=params)
+
+class MigrateVotesHandler(BatchHandler):
+    """
+    Move every answer's legacy voters list to Vote entities (votes cast
+    on an answer do the same for it first).
+    """
+    def query(self):
+        return Answer.query()
+
+    def handle_batch(self, answers):
+        for answer in answers:
+            if answer.voters:
+                migrate_answer_votes(answer)
+
+class RecountQuestionsHandler(webapp2.RequestHandler):
+    """
+    Rebuild the question counter from the stored questions. Run it once
+    after the counter is first deployed, or if it ever drifts.
+    """
+    def get(self):
+        count = Question.query().count()
+        keys = counter_keys('questions')
+        ndb.delete_multi(keys[1:])
+        CounterShard(key=keys[0], count=count).put()
+        self.response.write('%d questions counted' % count)
+
+class RenderContentHandler(BatchHandler):
+    """
+    Fill in ``content_html`` on the questions and answers saved before it
+    was stored: the questions first, then (``kind=Answer``) the answers.
+    Safe to run again: entities that have it are skipped, unless ``all=1``
+    asks to render everything again (after a change to ``render_content``).
+    """
+    def query(self):
+        if self.request.get('kind') == 'Answer':
+            return Answer.query()
+        return Question.query()
+
+    def handle_batch(self, entities):
+        everything = self.request.get('all') == '1'
+        todo = [entity for entity in entities
+                if everything or entity.content_html is None]
+        for entity in todo:
+            entity.content_html = render_content(entity.content)
+        ndb.put_multi(todo)
+        if todo:
+            bump_generation()
+
+    def finished(self):
+        if self.request.get('kind') != 'Answer':
+            taskqueue.add(url=self.request.path,
+                          params={'kind': 'Answer', 'all': self.request.get('all')})
+
+class RefreshActivityHandler(BatchHandler):
+    """
+    Recompute answer_count, vote_total, last_activity and the hot score
+    of every question from its answers, and store them in its summary.
+    Run it once after these fields are first deployed (the hot and
+    unanswered views only list questions that have them), or if they
+    ever drift. Safe to run again.
+    """
+    keys_only = True
+
+    def query(self):
+        return Question.query()
+
+    def handle_batch(self, keys):
+        refreshed = [key for key in keys if reload_activity(key)]
+        if refreshed:
+            bump_generation()
+
+class ReindexAnswersHandler(BatchHandler):
+    """
+    Put every answer again, so that the ones stored while ``vote`` was
+    unindexed enter the index the best-first order uses (a missing vote
+    becomes 0). Safe to run again.
+    """
+    keys_only = True
+
+    def query(self):
+        return Answer.query()
+
+    def handle_batch(self, keys):
+        for key in keys:
+            reindex_answer(key)
+
+class FlushViewsHandler(webapp2.RequestHandler):
+    """
+    Cron job writing the question views buffered in memcache to the
+    datastore (see cron.yaml).
+    """
+    def get(self):
+        self.response.write('%d question views flushed' % flush_views())
+
+class MigrateQuestionsHandler(webapp2.RequestHandler):
+    """
+    Move the questions still stored under the old single group
+    OLD_QUESTIONS_PARENT into their authors' groups, with their answers
+    and summaries. Old question links keep working through the redirects
+    left behind. Safe to run again.
+    """
+    def get(self):
+        moved = 0
+        for question in Question.query(ancestor=OLD_QUESTIONS_PARENT):
+            new_key = move_question(question.key)
+            if new_key:
+                update_tag_postings(question.key, question.created_date, question.tags, None)
+                update_tag_postings(new_key, question.created_date, None, question.tags)
+                queue_search_index(question.key, new_key)
+                moved += 1
+
+        if moved:
+            bump_generation()
+        self.response.write('%d questions moved' % moved)
+
+class RebuildTagPostingsHandler(BatchHandler):
+    """
+    Bring the tag postings in line with the stored questions: queue an
+    index_tags task for every question, and sweep the postings of the
+    deleted and retagged ones (see SweepTagPostingsHandler). The postings
+    are only changed one entry at a time, so tag listings keep working
+    while it runs. Run it once after the postings are first deployed, or
+    if they ever drift.
+    """
+    keys_only = True
+
+    def query(self):
+        return Question.query()
 
-        self.redirect("/Question?qid="+self.request.get('qid'))
+    def get(self):
+        super(RebuildTagPostingsHandler, self).get()
+        taskqueue.add(url='/tasks/sweep_tag_postings')
+
+    def handle_batch(self, keys):
+        if keys:
+            taskqueue.Queue().add([taskqueue.Task(url='/tasks/index_tags',
+                                                  params={'qid': key.urlsafe()})
+                                   for key in keys])
+
+class SweepTagPostingsHandler(BatchHandler):
+    """
+    Remove the postings of questions that are gone, no longer carry the
+    tag, or were posted with another date.
+    """
+    batch_size = 10   # shards, each holding the postings of many questions
+    keys_only = True
+
+    def query(self):
+        return TagPostings.query()
+
+    def handle_batch(self, keys):
+        for shard in ndb.get_multi(keys):
+            if shard is None:
+                continue
+            tag = shard.key.id().rsplit('#', 1)[0]
+            questions = ndb.get_multi([posting_question_key(entry) for entry in shard.postings])
+            for entry, question in zip(shard.postings, questions):
+                if question is None or tag not in posting_tags(question.tags) or \
+                   posting_entry(question.key, question.created_date) != entry:
+                    change_posting(shard.key, entry, False)
+
+class IndexTagsHandler(webapp2.RequestHandler):
+    """
+    Task adding one question to the postings of its tags (a no-op for the
+    postings it is already in).
+    """
+    def post(self):
+        question = ndb.Key(urlsafe=self.request.get('qid')).get()
+        if question:
+            update_tag_postings(question.key, question.created_date, None, question.tags)
+
+class IndexQuestionHandler(webapp2.RequestHandler):
+    """
+    Task bringing one question's search postings up to date, queued
+    whenever the question or one of its answers changes.
+    """
+    def post(self):
+        index_question(ndb.Key(urlsafe=self.request.get('qid')),
+                       rebuild=self.request.get('rebuild') == '1')
+        bump_generation()
+
+class RebuildSearchIndexHandler(webapp2.RequestHandler):
+    """
+    Queue an index task (see IndexQuestionHandler) for every stored
+    question, and for every indexed one deleted since. Run it once after
+    the search is first deployed, or if the index ever drifts.
+    """
+    def get(self):
+        queued = 0
+        cursor = None
+        more = True
+        while more:
+            keys, cursor, more = Question.query().fetch_page(100, start_cursor=cursor, keys_only=True)
+            if keys:
+                taskqueue.Queue().add([search_index_task(key, rebuild=True) for key in keys])
+            queued += len(keys)
+
+        # documents left behind by questions deleted since they were indexed
+        cursor = None
+        more = True
+        while more:
+            keys, cursor, more = SearchDocument.query().fetch_page(100, start_cursor=cursor, keys_only=True)
+            question_keys = [search_doc_question_key(key.id()) for key in keys]
+            questions = ndb.get_multi(question_keys)
+            queue_search_index(*[question_key for question_key, question in zip(question_keys, questions)
+                                 if question is None])
+
+        self.response.write('%d questions queued for indexing' % queued)
 
 class AlbumHomeHandler(webapp2.RequestHandler):
     def get(self):
@@ -594,5 +1849,18 @@ app = webapp2.WSGIApplication([
     ('/DeletePhoto', DeletePhotoHandler),
     ('/DeleteGallery', DeleteGalleryHandler),
     ('/About', AboutPageHandler),
-    ('/DeleteSuccess', DeleteSuccessHandler)
+    ('/DeleteSuccess', DeleteSuccessHandler),
+    ('/tasks/recount_questions', RecountQuestionsHandler),
+    ('/tasks/render_content', RenderContentHandler),
+    ('/tasks/migrate_questions', MigrateQuestionsHandler),
+    ('/tasks/refresh_activity', RefreshActivityHandler),
+    ('/tasks/reconcile_votes', ReconcileVotesHandler),
+    ('/tasks/migrate_votes', MigrateVotesHandler),
+    ('/tasks/reindex_answers', ReindexAnswersHandler),
+    ('/tasks/flush_views', FlushViewsHandler),
+    ('/tasks/rebuild_tag_postings', RebuildTagPostingsHandler),
+    ('/tasks/sweep_tag_postings', SweepTagPostingsHandler),
+    ('/tasks/index_tags', IndexTagsHandler),
+    ('/tasks/index_question', IndexQuestionHandler),
+    ('/tasks/rebuild_search_index', RebuildSearchIndexHandler)
 ], debug=True)
@@ -12,28 +12,100 @@ import datetime
 import logging
 
 from google.appengine.api import users
+from google.appengine.api import taskqueue
 
 from models import *
 from blog import FrontPageHandler
 from blog import SingleArticleHandler
+from blog import bump_generation
+from blog import JINJA_ENVIRONMENT
+from blog import affected_pages
+from blog import regenerate_pages
+from blog import page_id
 
 import webapp2
 import jinja2
 
 
-JINJA_ENVIRONMENT = jinja2.Environment(
-    loader = jinja2.FileSystemLoader(os.path.dirname(__file__)))
+PAGES_PER_TASK = 10
+REGENERATE_DELAY = 5   # seconds
+
+# -----------------------------------------------------------------------------
+# Functions
+# -----------------------------------------------------------------------------
+
+def split_tags(tags):
+    """
+    Turn the comma separated tags of a form field into a list.
+    """
+    if tags:
+        return [t.strip() for t in tags.split(',')]
+    return []
+
+def drop_article_pages(urlsafes):
+    """
+    Delete the stored pages of the given articles; each comes back on its
+    next anonymous view.
+    """
+    ndb.delete_multi([ndb.Key(RenderedPage, page_id('/Article', aid=urlsafe))
+                      for urlsafe in urlsafes])
+
+def queue_page_regeneration(page_ids):
+    """
+    Drop the given stored pages now and queue their rendering again, a
+    few per task. Until a task gets to a page, its next anonymous view
+    renders it. The delay lets the task overwrite a copy stored by a view
+    that was rendering while the write happened.
+    """
+    page_ids = sorted(page_ids)
+    ndb.delete_multi([ndb.Key(RenderedPage, page) for page in page_ids])
+    for i in range(0, len(page_ids), PAGES_PER_TASK):
+        taskqueue.add(url='/admin/tasks/regenerate_pages',
+                      params={'page': page_ids[i:i + PAGES_PER_TASK]},
+                      countdown=REGENERATE_DELAY)
+
+def queue_related_update(changes):
+    """
+    Queue a refresh of the related articles lists that a batch of
+    (urlsafe, before, after) changes can affect: the lists of the changed
+    articles and of every article sharing a tag with them.
+    """
+    def related_part(state):
+        return state and (state['title'], sorted(state['tags']))
+
+    aids = set()
+    tags = set()
+    for urlsafe, before, after in changes:
+        if related_part(before) == related_part(after):
+            continue
+        aids.add(urlsafe)
+        for state in (before, after):
+            if state:
+                tags.update(state['tags'])
+    if aids:
+        taskqueue.add(url='/admin/tasks/update_related',
+                      params={'aid': sorted(aids), 'tag': sorted(tags)})
+
+def refresh_related(urlsafes):
+    changed = RelatedArticles.update(urlsafes)
+    if changed:
+        bump_generation()
+        drop_article_pages(changed)
 
 # -----------------------------------------------------------------------------
 # Classes
 # -----------------------------------------------------------------------------
 
+
 class AdminHomePageHandler(FrontPageHandler):
     """
     Handles the main admin page, which lists all articles in the blog,
     with links to their corresponding edit pages. Also allows search
     by tags and/or search by year month
     """
+    home_url = '/admin'
+    article_url = '/admin/Article'
+
     def get(self):
 
         self.preprocess(Article, 'get_all')
@@ -43,58 +115,118 @@ class AdminHomePageHandler(FrontPageHandler):
             'page':self.page,
             'num_of_pages': self.num_of_pages,
             'PageCount':self.PageCount,
+            'page_url':self.page_url,
             'user':self.user,
             'admin':self.admin,
             'tag':self.tag,
-            'tags':self.tags,
             'tagstr':self.tagstr,
             'year':self.year,
             'month':self.month,
-            'group_by_month':self.group_by_month,
-            'month_count':self.month_count,
+            'sidebar':self.sidebar,
             'user_url':self.user_url,
             'user_url_linktext':self.user_url_linktext
         }
         template = JINJA_ENVIRONMENT.get_template('AdminHome.html')
         self.response.write(template.render(template_values))
 
-class NewArticleHandler(webapp2.RequestHandler):
-    """
-    Handles requests to create a new article, then redirect page to
-    /admin/EditArticle?aid=urlsafe
-    """
-    def get(self):
-        article = Article(title='place your new article\'s title here',
-                          content='Content goes here',
-                          draft=True)
-        article_key = article.put()
-        self.redirect('/admin/EditArticle?aid=' + article_key.urlsafe())
+    def post(self):
+        """
+        Applies one bulk action to the selected articles: publish,
+        unpublish, retag (add and/or remove tags) or delete. The articles
+        are read and written with one batch call each, and the aggregates,
+        the content generation and the stored pages are updated once for
+        the whole batch.
+        """
+        action = self.request.get('action')
+        add_tags = split_tags(cgi.escape(self.request.get('add_tags')))
+        remove_tags = split_tags(cgi.escape(self.request.get('remove_tags')))
+
+        keys = [ndb.Key(urlsafe=aid) for aid in self.request.get_all('aid')]
+        articles = [article for article in ndb.get_multi(keys) if article]
+
+        changes = []   # (urlsafe, before, after)
+        for article in articles:
+            before = article.live_state()
+            if action == 'publish':
+                article.draft = False
+            elif action == 'unpublish':
+                article.draft = True
+            elif action == 'retag':
+                tags = [t for t in article.tags if t not in remove_tags]
+                article.tags = tags + [t for t in add_tags if t not in tags]
+            if action == 'delete':
+                changes.append((article.key.urlsafe(), before, None))
+            else:
+                changes.append((article.key.urlsafe(), before, article.live_state()))
+
+        if action == 'delete':
+            ndb.delete_multi([key for article in articles
+                              for key in [article.key] + article.dependent_keys()])
+        elif action in ('publish', 'unpublish', 'retag'):
+            ndb.put_multi(articles + [ArticleSummary.for_article(article)
+                                      for article in articles])
+        else:
+            changes = []
+
+        if changes:
+            BlogStats.record_changes([(before, after) for urlsafe, before, after in changes])
+            bump_generation()
 
+            pages = set()
+            for urlsafe, before, after in changes:
+                pages |= affected_pages(urlsafe, before, after)
+            # Nothing is rendered here, however large the batch: the article
+            # pages are dropped and come back on their next view, the
+            # listings are dropped and rendered again by tasks.
+            drop_article_pages([urlsafe for urlsafe, before, after in changes])
+            queue_page_regeneration(pages - set(page_id('/Article', aid=urlsafe)
+                                                for urlsafe, before, after in changes))
+            queue_related_update(changes)
+
+        self.redirect('/admin')
 
 class EditArticleHandler(FrontPageHandler):
     """
     Handles from show to modify to submit an article in textarea.
     """
+    home_url = '/admin'
+    article_url = '/admin/Article'
+
     def get(self):
 
+        # start the article read first so it overlaps with the sidebar
+        article_future = ndb.Key(urlsafe=self.request.get('aid')).get_async()
+        self.render_editor(article_future)
+
+    def render_editor(self, article_future, new_aid=None):
+        """
+        Shows the edit form, empty when ``article_future`` is None, in
+        which case ``new_aid`` is the key the new article will be saved
+        under. A ``rev`` parameter loads that saved revision into the form.
+        """
         self.preprocess(Article, handleSinglePage = True)
 
         if self.user and self.admin:
-            article = ndb.Key(urlsafe=self.request.get('aid')).get()
+            article = article_future.get_result() if article_future else None
+            revision = self.request.get('rev')
+            if article and revision.isdigit():
+                restored = ArticleRevision.reconstruct(article, int(revision))
+                if restored:
+                    article.title, article.content = restored
             template_values = {
                 'article':article,
+                'new_aid':new_aid,
+                'revision':revision,
                 'articles':self.articles,
                 'page':self.page,
                 'num_of_pages': self.num_of_pages,
                 'user':self.user,
                 'admin':self.admin,
                 'tag':self.tag,
-                'tags':self.tags,
                 'tagstr':self.tagstr,
                 'year':self.year,
                 'month':self.month,
-                'group_by_month':self.group_by_month,
-                'month_count':self.month_count,
+                'sidebar':self.sidebar,
                 'user_url':self.user_url,
                 'user_url_linktext':self.user_url_linktext
             }
@@ -105,6 +237,13 @@ class EditArticleHandler(FrontPageHandler):
 
 
     def post(self):
+        """
+        Saves the form. The first save of a new article inserts it under
+        the id its form was given, so submitting that form again updates
+        the same article. A save that changes nothing is not written at
+        all, and one that changes the title or the content adds an
+        ``ArticleRevision`` to the article's history.
+        """
         title = self.request.get('title')
         content = self.request.get('content')
         article_urlsafe = cgi.escape(self.request.get('aid'))
@@ -116,12 +255,20 @@ class EditArticleHandler(FrontPageHandler):
         else:
             draft = True
 
-        if tags:
-            tags = [t.strip() for t in tags.split(',')]
-        else:
-            tags = []
+        tags = split_tags(tags)
 
-        article = ndb.Key(urlsafe=article_urlsafe).get()
+        if article_urlsafe:
+            article_key = ndb.Key(urlsafe=article_urlsafe)
+        else:
+            # a form posted without the key NewArticleHandler gives it
+            article_key = ndb.Key(Article, Article.allocate_ids(1)[0])
+        article = Article.get_or_insert_key(article_key, title=title, draft=True,
+                                            published_date=datetime.datetime.utcnow())
+        article_urlsafe = article.key.urlsafe()
+        is_new = not article.revision   # never saved through this form yet
+        before = article.live_state()
+        old_title, old_content = article.title, article.content
+        old_values = (article.title, article.content, article.tags, article.draft)
 
         is_published = article.draft and draft
         article.title = title
@@ -132,15 +279,41 @@ class EditArticleHandler(FrontPageHandler):
         #test_date = datetime.datetime(2016,2,1)
         #article.published_date = test_date
         # -------- for test only end ---------
-        article.put()
+        if not is_new and old_values == (article.title, article.content,
+                                         article.tags, article.draft):
+            self.redirect('/admin/Article?aid=' + article_urlsafe)
+            return
+
+        entities = [article, ArticleSummary.for_article(article)]
+        if is_new or article.title != old_title or article.content != old_content:
+            entities.append(article.new_revision(old_content))
+        ndb.put_multi(entities)
+        BlogStats.record_change(before, article.live_state())
+        bump_generation()
+        regenerate_pages(affected_pages(article_urlsafe, before, article.live_state()))
+        queue_related_update([(article_urlsafe, before, article.live_state())])
 
         self.redirect('/admin/Article?aid=' + article_urlsafe)
 
 
+class NewArticleHandler(EditArticleHandler):
+    """
+    Handles requests to write a new article: shows an empty edit form
+    carrying the id allocated for the article, which is only stored when
+    the form is first submitted.
+    """
+    def get(self):
+        new_key = ndb.Key(Article, Article.allocate_ids(1)[0])
+        self.render_editor(None, new_key.urlsafe())
+
+
 class AdminArticleHandler(SingleArticleHandler):
     """
     Handles to display a single article page in full size
     """
+    home_url = '/admin'
+    article_url = '/admin/Article'
+
     def get(self):
         self.preprocessArticle('AdminArticlePage.html')
 
@@ -159,7 +332,13 @@ class DeleteArticleHandler(webapp2.RequestHandler):
         else:
             article = ndb.Key(urlsafe = self.request.get('aid')).get()
             if article:
-                article.key.delete()
+                ndb.delete_multi([article.key] + article.dependent_keys())
+                BlogStats.record_change(article.live_state(), None)
+                bump_generation()
+                regenerate_pages(affected_pages(article.key.urlsafe(),
+                                                article.live_state(), None))
+                queue_related_update([(article.key.urlsafe(),
+                                       article.live_state(), None)])
                 self.redirect('/admin/PageDeleted')
 
 
@@ -185,6 +364,48 @@ class PageDeletedHandler(webapp2.RequestHandler):
         template = JINJA_ENVIRONMENT.get_template('DeletePage.html')
         self.response.write(template.render(template_values))
 
+class UpdateRelatedHandler(webapp2.RequestHandler):
+    """
+    Task refreshing the related articles lists after a write, queued by
+    ``queue_related_update``.
+    """
+    def post(self):
+        urlsafes = set(self.request.get_all('aid'))
+        urlsafes.update(RelatedArticles.neighbours(self.request.get_all('tag')))
+        refresh_related(sorted(urlsafes))
+
+
+class RegeneratePagesHandler(webapp2.RequestHandler):
+    """
+    Task rendering stored pages again after a bulk action, queued by
+    ``queue_page_regeneration``.
+    """
+    def post(self):
+        regenerate_pages(self.request.get_all('page'))
+
+
+class RebuildRelatedHandler(webapp2.RequestHandler):
+    """
+    Recomputes every related articles list, e.g. after an import or
+    when the lists were never built.
+    """
+    def get(self):
+        archive = BlogStats.get_archive()
+        orphans = [key for key in RelatedArticles.query().iter(keys_only=True)
+                   if key.parent().urlsafe() not in archive]
+        ndb.delete_multi(orphans)
+        refresh_related(archive.keys())
+        self.response.write('Rebuilt the related articles of %d articles.'
+                            % len(archive))
+
+class FlushViewsHandler(webapp2.RequestHandler):
+    """
+    Cron job writing the article views buffered in memcache to the
+    datastore (see cron.yaml).
+    """
+    def get(self):
+        self.response.write('Flushed the views of %d articles.' % ViewCount.flush())
+
 # -----------------------------------------------------------------------------
 # Main program
 # -----------------------------------------------------------------------------
@@ -195,5 +416,9 @@ app = webapp2.WSGIApplication([
     ('/admin/EditArticle', EditArticleHandler),
     ('/admin/Article', AdminArticleHandler),
     ('/admin/DeleteArticle', DeleteArticleHandler),
-    ('/admin/PageDeleted',PageDeletedHandler)
+    ('/admin/PageDeleted',PageDeletedHandler),
+    ('/admin/tasks/update_related', UpdateRelatedHandler),
+    ('/admin/tasks/regenerate_pages', RegeneratePagesHandler),
+    ('/admin/tasks/rebuild_related', RebuildRelatedHandler),
+    ('/admin/tasks/flush_views', FlushViewsHandler)
     ],debug=True)
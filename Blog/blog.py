@@ -12,12 +12,17 @@ import os
 import sys
 import math
 import random
+import time
+import urllib
+import hashlib
 import logging
 import datetime
 
 # Google AppEngine imports
 from google.appengine.api import users
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
 
 from models import *
 
@@ -30,15 +35,87 @@ import jinja2
 
 MAX_ARTICLES_PER_PAGE = 5
 MAX_PAGE_LIST = 2
+SIDEBAR_CACHE_TIME = 60 * 60 * 24
+PUBLIC_CACHE_TIME = 60 * 5
 
+FEED_SIZE = 20
+
+# stand-ins for the per-request parts of a pre-rendered page
+SIDEBAR_PLACEHOLDER = '<!-- sidebar -->'
+LOGIN_URL_PLACEHOLDER = '__login_url__'
+HOST_URL_PLACEHOLDER = '__host_url__'
+VIEW_COUNT_PLACEHOLDER = '__view_count__'
+
+# The app runs threadsafe, so module level objects are shared by concurrent
+# requests. The Environment is only read after this point (its template
+# cache is locked internally) and is shared with admin.py; everything that
+# belongs to a request lives on the handler instance webapp2 creates for it.
 JINJA_ENVIRONMENT = jinja2.Environment(
     loader = jinja2.FileSystemLoader(os.path.dirname(__file__)))
 
 
+@ndb.tasklet
+def get_generation_async():
+    """
+    Time of the last write to the blog content, as a float timestamp.
+    Cached sidebar fragments and the HTTP validators of the public pages
+    are derived from it, so bumping it invalidates all of them at once.
+    """
+    context = ndb.get_context()
+    generation = yield context.memcache_get('content_generation')
+    if generation is None:
+        # A generation lost to eviction restarts at the current time, newer
+        # than anything cached before, so stale copies are never reused.
+        yield context.memcache_add('content_generation', time.time())
+        generation = yield context.memcache_get('content_generation')
+    raise ndb.Return(generation or time.time())
+
+
+def answer_conditional(handler, last_modified):
+    """
+    Answer 304 Not Modified when the request's If-None-Match (or, failing
+    that, If-Modified-Since) matches the ETag already set on the response
+    or ``last_modified``. Returns True when nothing is left to render.
+    """
+    if handler.request.if_none_match:
+        current = handler.response.etag in handler.request.if_none_match
+    elif handler.request.if_modified_since:
+        current = last_modified <= handler.request.if_modified_since.replace(tzinfo=None)
+    else:
+        current = False
+
+    if current:
+        handler.response.set_status(304)
+    return current
+
+
+def bump_generation():
+    """
+    Record a write to the blog content; call after any article write.
+    """
+    client = memcache.Client()
+    for i in range(10):
+        current = client.gets('content_generation')
+        # never move backwards, even with clock skew between instances
+        generation = max(time.time(), (current or 0) + 0.001)
+        if current is None:
+            if client.add('content_generation', generation):
+                return
+        elif client.cas('content_generation', generation):
+            return
+    client.set('content_generation', time.time())
+
+
 class FrontPageHandler(webapp2.RequestHandler):
     """
     Handles requests to display the home page of the blog.
     """
+    # where the sidebar's tag, month and article links point to
+    home_url = '/'
+    article_url = '/Article'
+    # set when rendering the stored copy of a page, see render_for_storage
+    prerender = False
+
     def get_page_list(self, page=0, num_of_pages=1):
         PageCount = {}
         pl = []
@@ -69,9 +146,163 @@ class FrontPageHandler(webapp2.RequestHandler):
         return PageCount
 
 
-    def preprocess(self, cls, funcName = 'get_all', handleSinglePage = False):
+    @ndb.tasklet
+    def get_sidebar_async(self, cls):
+        """
+        Render the tag cloud and month archive, or reuse the fragment cached
+        in memcache for the current sidebar generation.
+        """
+        context = ndb.get_context()
+        generation = yield get_generation_async()
+        cache_key = 'sidebar:%s:%r' % (self.home_url, generation)
+        sidebar = yield context.memcache_get(cache_key)
+        if sidebar is None:
+            # one read of each aggregate, the calls below hit the context cache
+            yield BlogStats.get_stats_async(), BlogStats.get_archive_async()
+            template_values = {
+                'tags':cls.get_tag_counts(),
+                'month_count':cls.get_month_counts(),
+                'group_by_month':cls.get_archive(),   # { DateCount: [ArchiveEntry, ...] }
+                'home_url':self.home_url,
+                'article_url':self.article_url
+            }
+            template = JINJA_ENVIRONMENT.get_template('Sidebar.html')
+            sidebar = template.render(template_values)
+            yield context.memcache_add(cache_key, sidebar, SIDEBAR_CACHE_TIME)
+        raise ndb.Return(sidebar)
+
+
+    @ndb.tasklet
+    def fetch_page_async(self, query_for, page):
+        """
+        Fetch one page of the listing built by ``query_for(reverse)``.
+
+        ``cursor`` in the URL pages forward from an opaque datastore cursor,
+        ``before`` pages backward to one, so walking through the listing
+        never pays for skipped entities. A bare ``page`` number (a direct
+        jump from the page list) falls back to an offset.
+
+        The query is keys only; what the page shows comes from the small
+        ``ArticleSummary`` entities rather than the full articles.
+
+        :rtype: tuple
+        :return: (articles, prev_cursor, next_cursor), articles being
+                 ``ArticleSummary`` entities and cursors urlsafe or None
+        """
+        cursor = self.request.get('cursor')
+        before = self.request.get('before')
+
+        if before:
+            end = Cursor(urlsafe=before)
+            keys, start, more = yield query_for(True).fetch_page_async(
+                MAX_ARTICLES_PER_PAGE, start_cursor=end.reversed(), keys_only=True)
+            keys.reverse()
+            if more and start:
+                prev_cursor = start.reversed().urlsafe()
+            else:
+                prev_cursor = None
+            next_cursor = before
+        else:
+            if cursor:
+                keys, end, more = yield query_for(False).fetch_page_async(
+                    MAX_ARTICLES_PER_PAGE, start_cursor=Cursor(urlsafe=cursor),
+                    keys_only=True)
+                prev_cursor = cursor
+            else:
+                keys, end, more = yield query_for(False).fetch_page_async(
+                    MAX_ARTICLES_PER_PAGE, offset=MAX_ARTICLES_PER_PAGE * page,
+                    keys_only=True)
+                prev_cursor = None
+
+            if more and end:
+                next_cursor = end.urlsafe()
+            else:
+                next_cursor = None
+
+        articles = yield ArticleSummary.get_for_articles_async(keys)
+        raise ndb.Return((articles, prev_cursor, next_cursor))
+
+
+    @ndb.tasklet
+    def fetch_archive_page_async(self, tag, year, month, page):
+        """
+        Fetch one page of a listing for its stored copy. The listing
+        queries are eventually consistent, so run right after a write they
+        can miss the article just published or still return the one just
+        unpublished, and the stored copy would keep that until the next
+        write. The page is ordered from ``BlogArchive`` instead, which the
+        write updates in a transaction, and filled by key.
+
+        :rtype: tuple
+        :return: (articles, None, None), the later pages being reached
+                 by offset
+        """
+        archive = yield BlogStats.get_archive_async()
+        keys = archive_listing(archive, tag, year, month)
+        start = page * MAX_ARTICLES_PER_PAGE
+        articles = yield ArticleSummary.get_for_articles_async(
+            keys[start:start + MAX_ARTICLES_PER_PAGE])
+        raise ndb.Return((articles, None, None))
+
+
+    def not_modified(self, generation):
+        """
+        Set the validators and caching headers of the response from the
+        content generation, and answer 304 Not Modified when the client's
+        copy is still current.
+
+        :rtype: bool
+        :return: True when a 304 was sent and nothing is left to render
+        """
         user = users.get_current_user()
-        admin = users.is_current_user_admin()  # boolean value
+        last_modified = datetime.datetime.utcfromtimestamp(int(generation))
+        self.response.etag = hashlib.md5('%r|%s|%s' % (
+            generation, self.request.path_qs,
+            user.user_id() if user else '')).hexdigest()
+        self.response.last_modified = last_modified
+
+        if user:
+            self.response.headers['Cache-Control'] = 'private, max-age=0'
+        else:
+            # anonymous pages are the same for everyone: let the edge cache them
+            self.response.headers['Cache-Control'] = 'public, max-age=%d' % PUBLIC_CACHE_TIME
+            self.response.headers['Vary'] = 'Cookie'
+
+        return answer_conditional(self, last_modified)
+
+
+    def page_url(self, i):
+        """
+        Link to page ``i`` of the current listing. The neighbouring pages
+        are reached by cursor; only jumps further away use an offset.
+        """
+        params = []
+        if self.tagstr:
+            params.append(('tag', self.tagstr.encode('utf-8')))
+        if self.year and self.month:
+            params += [('year', self.year), ('month', self.month)]
+
+        if i == self.page + 1 and self.next_cursor:
+            params += [('page', i), ('cursor', self.next_cursor)]
+        elif i == self.page - 1 and i > 0 and self.prev_cursor:
+            params += [('page', i), ('before', self.prev_cursor)]
+        elif i > 0:
+            params.append(('page', i))
+
+        if params:
+            return self.home_url + '?' + urllib.urlencode(params)
+        return self.home_url
+
+
+    def preprocess(self, cls, funcName = 'get_all', handleSinglePage = False):
+        if self.prerender:
+            # stored copies are rendered for an anonymous visitor, with the
+            # per-request parts left as placeholders for get_page_html
+            user = None
+            admin = False
+        else:
+            user = users.get_current_user()
+            admin = users.is_current_user_admin()  # boolean value
 
         if handleSinglePage:
             max_page_size = 1
@@ -82,6 +313,8 @@ class FrontPageHandler(webapp2.RequestHandler):
             page = 0
             num_of_pages = 1
             articles = []
+            prev_cursor = None
+            next_cursor = None
             PageCount = None
         else:
             max_page_size = 5
@@ -92,13 +325,21 @@ class FrontPageHandler(webapp2.RequestHandler):
 
             func = getattr(cls, funcName)  # returns the handler of cls.funcName
 
+            # query_for(reverse) builds the listing query in either direction,
+            # the total comes from a maintained counter (None if there is none)
             if tag[0]!='':
-                articles_query = cls.search_for_tag(tag)
+                query_for = lambda reverse: cls.search_for_tag(tag, reverse)
+                total_future = cls.count_published_async(tags=tag)
                 tagstr = " ".join(tag)
             elif year and month:
-                articles_query = cls.search_for_month(int(year), int(month))
+                query_for = lambda reverse: cls.search_for_month(int(year), int(month), reverse)
+                total_future = cls.count_published_async(year=int(year), month=int(month))
             else:
-                articles_query = func()
+                query_for = func
+                if funcName == 'published':
+                    total_future = cls.count_published_async()
+                else:
+                    total_future = None
 
             page = self.request.get('page')
             if page:
@@ -106,48 +347,90 @@ class FrontPageHandler(webapp2.RequestHandler):
             else:
                 page = 0
 
-            num_of_pages =  int(math.ceil(articles_query.count() / float(MAX_ARTICLES_PER_PAGE)))
-            articles = articles_query.fetch(MAX_ARTICLES_PER_PAGE, offset=MAX_ARTICLES_PER_PAGE * page)   # a list of articles
-
-            PageCount = self.get_page_list(page, num_of_pages)
-
-        tags = cls.get_tag_counts()
-
-        group_by_month = {}
-
-        month_count = cls.get_month_counts()
+            if self.prerender:
+                page_future = self.fetch_archive_page_async(
+                    tag[0], int(year or 0), int(month or 0), page)
+            else:
+                page_future = self.fetch_page_async(query_for, page)
 
-        for dct in month_count:
-            # all_in_month is a query object
-            all_in_month = cls.search_for_month(dct.date.year, dct.date.month)
-            group_by_month[dct] = all_in_month
+        # The page, the counters and the sidebar are all in flight together
+        # from here on; nothing waits on them before they are needed below.
+        if self.prerender:
+            sidebar_future = None
+        else:
+            sidebar_future = self.get_sidebar_async(cls)
 
-        if user:
+        if self.prerender:
+            user_url = LOGIN_URL_PLACEHOLDER
+            user_url_linktext = 'Login'
+        elif user:
             user_url = users.create_logout_url(self.request.uri)
             user_url_linktext = 'Logout'
         else:
             user_url = users.create_login_url(self.request.uri)
             user_url_linktext = 'Login'
 
+        if not handleSinglePage:
+            articles, prev_cursor, next_cursor = page_future.get_result()   # a list of articles
+
+            total = total_future.get_result() if total_future else None
+            if total is not None:
+                num_of_pages = int(math.ceil(total / float(MAX_ARTICLES_PER_PAGE)))
+            else:
+                # all we know without a counter is whether a next page exists
+                num_of_pages = page + (2 if next_cursor else 1)
+
+            PageCount = self.get_page_list(page, num_of_pages)
+
+        if sidebar_future:
+            sidebar = sidebar_future.get_result()
+        else:
+            sidebar = SIDEBAR_PLACEHOLDER
+
         self.user = user
         self.admin = admin
         self.max_page_size = max_page_size
         self.page = page
         self.tag = tag
-        self.tags = tags
         self.tagstr = tagstr
         self.year = year
         self.month = month
-        self.group_by_month = group_by_month
-        self.month_count = month_count
+        self.sidebar = sidebar
         self.articles = articles
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
         self.num_of_pages = num_of_pages
         self.PageCount = PageCount
         self.user_url = user_url
         self.user_url_linktext = user_url_linktext
 
 
-    def get(self):
+    def get_page_html(self):
+        """
+        Anonymous visitors of the pages kept in ``RenderedPage`` get the
+        stored copy, rendered when its articles last changed, with only the
+        sidebar and login link filled in. Everyone else gets a fresh render.
+        """
+        page_id = prerender_id(self.request)
+        if page_id is None or users.get_current_user():
+            return self.render_page()
+
+        # start the sidebar now, it is needed whether the copy exists or not
+        sidebar_future = self.get_sidebar_async(Article)
+        page = RenderedPage.get_by_id(page_id)
+        if page is None:
+            html = render_for_storage(page_id)
+            if html is None:
+                return self.render_page()
+            page = RenderedPage(id=page_id, html=html)
+            page.put()
+
+        return page.html\
+                   .replace(SIDEBAR_PLACEHOLDER, sidebar_future.get_result())\
+                   .replace(LOGIN_URL_PLACEHOLDER, users.create_login_url(self.request.uri))
+
+
+    def render_page(self):
 
         self.preprocess(Article, 'published')
 
@@ -156,20 +439,27 @@ class FrontPageHandler(webapp2.RequestHandler):
             'page':self.page,
             'num_of_pages': self.num_of_pages,
             'PageCount':self.PageCount,
+            'page_url':self.page_url,
             'user':self.user,
             'admin':self.admin,
             'tag':self.tag,
-            'tags':self.tags,
             'tagstr':self.tagstr,
             'year':self.year,
             'month':self.month,
-            'group_by_month':self.group_by_month,
-            'month_count':self.month_count,
+            'sidebar':self.sidebar,
             'user_url':self.user_url,
             'user_url_linktext':self.user_url_linktext
         }
         template = JINJA_ENVIRONMENT.get_template('BlogHome.html')
-        self.response.write(template.render(template_values))
+        return template.render(template_values)
+
+
+    def get(self):
+
+        if self.not_modified(get_generation_async().get_result()):
+            return
+
+        self.response.write(self.get_page_html())
 
 
 class SingleArticleHandler(FrontPageHandler):
@@ -177,34 +467,214 @@ class SingleArticleHandler(FrontPageHandler):
     Handles requests to display a single article, given its unique ID.
     Handles nonexistent IDs.
     """
-    def preprocessArticle(self, htmlPage='ArticlePage.html'):
+    def render_article(self, htmlPage='ArticlePage.html'):
+
+        # start the article reads first so they overlap with the sidebar
+        article_key = ndb.Key(urlsafe=self.request.get('aid'))
+        article_future = article_key.get_async()
+        related_future = RelatedArticles.related_key(article_key).get_async()
 
         self.preprocess(Article, handleSinglePage = True)
 
-        article = ndb.Key(urlsafe=self.request.get('aid')).get()  # it's an article entity
+        article = article_future.get_result()  # it's an article entity
+        if article is None and self.prerender:
+            return None   # nothing to store for a deleted article
+        related = related_future.get_result()
 
         template_values = {
             'article':article,
+            'related':related.articles if related else [],
+            'views':VIEW_COUNT_PLACEHOLDER,   # filled in by write_article
+            'article_url':self.article_url,
             'articles':self.articles,
             'page':self.page,
             'num_of_pages': self.num_of_pages,
             'user':self.user,
             'admin':self.admin,
             'tag':self.tag,
-            'tags':self.tags,
             'year':self.year,
             'month':self.month,
-            'group_by_month':self.group_by_month,
-            'month_count':self.month_count,
+            'sidebar':self.sidebar,
             'user_url':self.user_url,
             'user_url_linktext':self.user_url_linktext
         }
 
         template = JINJA_ENVIRONMENT.get_template(htmlPage)
-        self.response.write(template.render(template_values))
+        return template.render(template_values)
+
+    def write_article(self, render):
+        """
+        Write the page made by ``render()`` with the article's view count
+        filled in. The count is left out of the render itself, so that
+        the stored copy of the page stays valid as views come in.
+        """
+        views_future = ViewCount.get_views_async(ndb.Key(urlsafe=self.request.get('aid')))
+        html = render()
+        self.response.write(html.replace(VIEW_COUNT_PLACEHOLDER, str(views_future.get_result())))
+
+    def preprocessArticle(self, htmlPage='ArticlePage.html'):
+        self.write_article(lambda: self.render_article(htmlPage))
+
+    def render_page(self):
+        return self.render_article('ArticlePage.html')
+
+    def get(self):
+        # counted before the 304 check: a revalidated copy is a view too
+        ViewCount.record_view(ndb.Key(urlsafe=self.request.get('aid')))
+        if self.not_modified(get_generation_async().get_result()):
+            return
+        self.write_article(self.get_page_html)
 
+
+class FeedHandler(webapp2.RequestHandler):
+    """
+    Serves the Atom feed of the newest published articles from its stored
+    copy, which is rebuilt whenever an article is written, so pollers
+    never trigger the listing queries and mostly get a 304.
+    """
     def get(self):
-        self.preprocessArticle('ArticlePage.html')
+        page = RenderedPage.get_by_id('/feed')
+        if page is None:
+            page = RenderedPage(id='/feed', html=render_feed())
+            page.put()
+
+        self.response.headers['Content-Type'] = 'application/atom+xml; charset=utf-8'
+        self.response.headers['Cache-Control'] = 'public, max-age=%d' % PUBLIC_CACHE_TIME
+        self.response.etag = hashlib.md5('%s|%s' % (
+            self.request.host_url, page.html.encode('utf-8'))).hexdigest()
+        last_modified = page.rendered_date.replace(microsecond=0)
+        self.response.last_modified = last_modified
+
+        if answer_conditional(self, last_modified):
+            return
+
+        self.response.write(page.html.replace(HOST_URL_PLACEHOLDER, self.request.host_url))
+
+
+# -----------------------------------------------------------------------------
+# Pre-rendered pages
+# -----------------------------------------------------------------------------
+
+def page_id(path, **params):
+    """
+    Canonical id of a pre-rendered page: its path and sorted query.
+    """
+    if not params:
+        return path
+    query = sorted((name, unicode(value).encode('utf-8'))
+                   for name, value in params.items())
+    return path + '?' + urllib.urlencode(query)
+
+
+def prerender_id(request):
+    """
+    Id of the stored copy that can answer this request, or None for the
+    requests that are always rendered (later pages of a listing, searches
+    for several tags at once, tags and months without a published article).
+    """
+    params = dict(request.GET.items())
+    names = sorted(params.keys())
+    if request.path == '/Article':
+        if names == ['aid']:
+            return page_id('/Article', aid=params['aid'])
+    elif request.path == '/':
+        if not names:
+            return '/'
+        if names == ['tag'] and params['tag'] and ' ' not in params['tag']:
+            if params['tag'] in BlogStats.get_stats().tag_counts:
+                return page_id('/', tag=params['tag'])
+        if names == ['month', 'year'] and \
+           params['year'].isdigit() and params['month'].isdigit():
+            year, month = int(params['year']), int(params['month'])
+            if 1 <= month <= 12 and \
+               '%04d-%02d' % (year, month) in BlogStats.get_stats().month_counts:
+                return page_id('/', year=year, month=month)
+    return None
+
+
+def archive_listing(archive, tag=None, year=0, month=0):
+    """
+    Keys of the published articles in a listing, in the order of
+    ``Article.date_order`` (newest first, then by key), from the archive
+    kept in ``BlogArchive`` rather than from an eventually consistent query.
+    """
+    month_prefix = '%04d-%02d' % (year, month) if year and month else ''
+    entries = [(published, ndb.Key(urlsafe=urlsafe))
+               for urlsafe, (title, published, tags) in archive.iteritems()
+               if (not tag or tag in tags) and published.startswith(month_prefix)]
+    entries.sort(key=lambda entry: entry[1])
+    entries.sort(key=lambda entry: entry[0], reverse=True)
+    return [key for published, key in entries]
+
+
+def render_feed():
+    """
+    Render the Atom feed, with the host left as a placeholder. It is
+    rebuilt right after each write, so its articles are chosen from the
+    archive and read by key: a query run then could leave out the article
+    just published, and the stored feed would tell pollers nothing is new.
+    """
+    keys = archive_listing(BlogStats.get_archive())[:FEED_SIZE]
+    template_values = {
+        'articles':[article for article in ndb.get_multi(keys)
+                    if article and not article.draft],
+        'updated':datetime.datetime.utcnow(),
+        'host_url':HOST_URL_PLACEHOLDER
+    }
+    template = JINJA_ENVIRONMENT.get_template('feed.xml')
+    return template.render(template_values)
+
+
+def render_for_storage(page_id):
+    """
+    Render the anonymous copy of a pre-rendered page, or None if there is
+    nothing to show (a deleted article, a tag or month left empty).
+    """
+    if page_id == '/feed':
+        return render_feed()
+    request = webapp2.Request.blank(page_id.encode('utf-8'))
+    if prerender_id(request) != page_id:
+        return None
+    if request.path == '/Article':
+        handler = SingleArticleHandler(request, webapp2.Response())
+    else:
+        handler = FrontPageHandler(request, webapp2.Response())
+    handler.prerender = True
+    return handler.render_page()
+
+
+def affected_pages(urlsafe, before, after):
+    """
+    Ids of the pre-rendered pages that show an article, given its state
+    before and after a write (as returned by ``Article.live_state()``).
+    """
+    pages = set(['/', '/feed', page_id('/Article', aid=urlsafe)])
+    for state in (before, after):
+        if state is None:
+            continue
+        for tag in state['tags']:
+            if tag and ' ' not in tag:
+                pages.add(page_id('/', tag=tag))
+        year, month = state['month'].split('-')
+        pages.add(page_id('/', year=int(year), month=int(month)))
+    return pages
+
+
+def regenerate_pages(page_ids):
+    """
+    Re-render the given pre-rendered pages after a write, dropping the
+    ones that no longer have anything to show.
+    """
+    pages = []
+    stale = []
+    for page_id in page_ids:
+        html = render_for_storage(page_id)
+        if html is None:
+            stale.append(ndb.Key(RenderedPage, page_id))
+        else:
+            pages.append(RenderedPage(id=page_id, html=html))
+    ndb.put_multi(pages)
+    ndb.delete_multi(stale)
 
 
 # -----------------------------------------------------------------------------
@@ -213,5 +683,6 @@ class SingleArticleHandler(FrontPageHandler):
 
 app = webapp2.WSGIApplication([
     ('/', FrontPageHandler),
-    ('/Article', SingleArticleHandler)
+    ('/Article', SingleArticleHandler),
+    ('/feed', FeedHandler)
     ],debug=True)
@@ -1,6 +1,9 @@
+import re
 import datetime
+import difflib
 import math
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 class DateCount(object):
@@ -35,6 +38,19 @@ class TagCount(object):
     def __cmp__(self, other):
         return cmp(self.count, other.count)
 
+class ArchiveEntry(object):
+    """
+    Convenience class for the (key, title, date) listing of the sidebar
+    archive, sorted by publication date.
+    """
+    def __init__(self, urlsafe, title, published):
+        self.key = ndb.Key(urlsafe=urlsafe)
+        self.title = title
+        self.published = published
+
+    def __cmp__(self, other):
+        return cmp(self.published, other.published)
+
 class Article(ndb.Model):
 
     title = ndb.StringProperty(required=True)
@@ -43,10 +59,35 @@ class Article(ndb.Model):
     tags = ndb.StringProperty(repeated=True)
     id = ndb.StringProperty()
     draft = ndb.BooleanProperty(required=True, default=False)
+    revision = ndb.IntegerProperty(default=0, indexed=False)
+
+    @classmethod
+    @ndb.transactional
+    def get_or_insert_key(cls, key, **values):
+        """
+        ``get_or_insert`` for a key with a numeric id, as allocate_ids
+        gives: the stored article, or a new one with ``values`` put now.
+        """
+        article = key.get()
+        if article is None:
+            article = cls(key=key, **values)
+            article.put()
+        return article
+
+    @classmethod
+    def date_order(cls, reverse=False):
+        """
+        Newest first, with the key as tie breaker so that cursors are stable
+        (and allowed at all on the IN queries of ``search_for_tag``).
+        ``reverse`` gives the opposite order, used to page backwards.
+        """
+        if reverse:
+            return [Article.published_date, -Article.key]
+        return [-Article.published_date, Article.key]
 
     @classmethod
-    def get_all(cls):
-        q = Article.query().order(-Article.published_date)
+    def get_all(cls, reverse=False):
+        q = Article.query().order(*Article.date_order(reverse))
         return q   # return a Query object, not a list of entities
 
     @classmethod
@@ -63,51 +104,22 @@ class Article(ndb.Model):
         return q   # Query Object
 
     @classmethod
-    def published(cls):
-        return Article.published_query().order(-Article.published_date)
+    def published(cls, reverse=False):
+        return Article.published_query().order(*Article.date_order(reverse))
 
     @classmethod
     def get_all_tags(cls):
         """
         Return all tags, as TagCount objects:
         { 'tagName1': 10, 'tagName12': 20 }
-        """
-        tag_counts = {}
-        for article in Article.published():
-            for tag in article.tags:
-                tag = unicode(tag)
-                try:
-                    tag_counts[tag] += 1
-                except KeyError:
-                    tag_counts[tag] = 1
-
-                """  # equivlant to the following code:
-                if tag_counts.has_key(tag):
-                    tag_counts[tag] += 1
-                else:
-                    tag_counts[tag] = 1   """
-
-        return tag_counts
 
-    @classmethod
-    def get_all_datetimes(cls):
-        dates = {}
-        for article in Article.published():
-            """class datetime.datetime   https://docs.python.org/2/library/datetime.html
-            A combination of a date and a time. Attributes:
-            year, month, day, hour, minute, second, microsecond, and tzinfo."""
-            date = datetime.datetime(article.published_date.year,
-                                     article.published_date.month,
-                                     article.published_date.day)
-            try:
-                dates[date] += 1
-            except KeyError:
-                dates[date] = 1
-
-        return dates
+        Served from the materialized ``BlogStats`` aggregate, so this is a
+        single entity read rather than a scan of every published article.
+        """
+        return BlogStats.get_stats().tag_counts
 
     @classmethod
-    def search_for_month(cls, year, month):
+    def search_for_month(cls, year, month, reverse=False):
         """
         Get article query object that matches the requirment.
         requirment --> Article.published_date.year == year
@@ -128,10 +140,10 @@ class Article(ndb.Model):
         return Article.published_query()\
                        .filter(Article.published_date >= start_date)\
                        .filter(Article.published_date < end_date)\
-                       .order(-Article.published_date)
+                       .order(*Article.date_order(reverse))
 
     @classmethod
-    def search_for_tag(cls, tags):
+    def search_for_tag(cls, tags, reverse=False):
         """
         Get article query object that matches the requirment.
         requirment --> one or more tag in tags list matches any tag in article.tags
@@ -141,8 +153,66 @@ class Article(ndb.Model):
         """
         return Article.published_query()\
                       .filter(Article.tags.IN(tags))\
-                      .order(-Article.published_date)
+                      .order(*Article.date_order(reverse))
+
+    @classmethod
+    @ndb.tasklet
+    def count_published_async(cls, tags=None, year=0, month=0):
+        """
+        Number of published articles matching a listing, read from the
+        ``BlogStats`` counters instead of a ``count()`` over the index.
+
+        :rtype: int or None
+        :return: None when no counter covers the listing (several tags,
+                 where articles carrying more than one would be counted twice)
+        """
+        stats = yield BlogStats.get_stats_async()
+        if tags:
+            if len(tags) > 1:
+                raise ndb.Return(None)
+            raise ndb.Return(stats.tag_counts.get(tags[0], 0))
+        if year and month:
+            raise ndb.Return(stats.month_counts.get('%04d-%02d' % (year, month), 0))
+        raise ndb.Return(sum(stats.month_counts.values()))
+
+
+    def live_state(self):
+        """
+        What this article currently contributes to the blog aggregates
+        kept in ``BlogStats``. Drafts contribute nothing.
+
+        :rtype: dict or None
+        """
+        if self.draft:
+            return None
+        return {'key': self.key.urlsafe(),
+                'title': self.title,
+                'tags': [unicode(tag) for tag in self.tags],
+                'month': self.published_date.strftime('%Y-%m'),
+                'published': self.published_date.strftime('%Y-%m-%dT%H:%M:%S.%f')}
+
+    def new_revision(self, old_content):
+        """
+        Count one more saved revision of this article and return the
+        ``ArticleRevision`` recording it, to be put along with the article.
+        ``old_content`` is the content of the previous revision.
+        """
+        self.revision += 1
+        return ArticleRevision.create(self.key, self.revision, self.title,
+                                      old_content, self.content)
 
+    def revision_keys(self):
+        return [ArticleRevision.revision_key(self.key, number)
+                for number in range(1, self.revision + 1)]
+
+    def dependent_keys(self):
+        """
+        Keys of the entities stored under this article, deleted with it.
+        """
+        return (self.revision_keys() +
+                [ArticleSummary.summary_key(self.key),
+                 RelatedArticles.related_key(self.key),
+                 ViewCount.view_key(self.key)])
 
     def __unicode__(self):
         return self.__str__()
@@ -200,22 +270,534 @@ class Article(ndb.Model):
         """
         Get date counts, sorted in reverse chronological order.
 
+        Read from the year/month histogram in ``BlogStats``, so the cost is
+        proportional to the number of months rather than of articles.
+
         :rtype: list
         :return: list of ``DateCount`` objects
         """
-        # get_all_datetimes() returns a set dates, where
-        # dates = { 'date1': count, 'date2': count }
-        datetime_set = Article.get_all_datetimes()
-        datetimes = datetime_set.keys()
-        date_count = {}
-        for dt in datetimes:
-            just_year_month = datetime.date(dt.year, dt.month, 1)
-            try:
-                date_count[just_year_month] += datetime_set[dt]
-            except KeyError:
-                date_count[just_year_month] = datetime_set[dt]
-
-        dates = date_count.keys()
-        dates.sort()
-        dates.reverse()
-        return [DateCount(date, date_count[date]) for date in dates]
+        # month_counts = { '2016-02': count, '2016-03': count }
+        month_counts = BlogStats.get_stats().month_counts
+        result = []
+        for month, count in month_counts.items():
+            year, month = month.split('-')
+            result.append(DateCount(datetime.date(int(year), int(month), 1), count))
+
+        result.sort()
+        result.reverse()
+        return result
+
+    @classmethod
+    def get_archive(cls):
+        """
+        Group the published articles by month for the sidebar archive,
+        from the listing kept in ``BlogArchive`` instead of one query per month.
+
+        :rtype: dict
+        :return: { DateCount: [ArchiveEntry, ...] }, newest article first
+        """
+        # archive = { 'urlsafe': [title, '2016-02-01T10:00:00', tags] }
+        archive = BlogStats.get_archive()
+        group_by_month = {}
+        for urlsafe, (title, published, tags) in archive.items():
+            date = datetime.date(int(published[:4]), int(published[5:7]), 1)
+            group_by_month.setdefault(DateCount(date, 0), []).append(
+                ArchiveEntry(urlsafe, title, published))
+
+        for month, entries in group_by_month.items():
+            month.count = len(entries)
+            entries.sort()
+            entries.reverse()
+        return group_by_month
+
+
+def make_excerpt(content, length):
+    """
+    Plain text teaser of an HTML body: tags dropped, whitespace collapsed
+    and cut at a word boundary.
+
+    :rtype: tuple
+    :return: (excerpt, truncated)
+    """
+    text = u' '.join(re.sub(r'<[^>]*>', u' ', content or u'').split())
+    if len(text) <= length:
+        return text, False
+    cut = text.rfind(u' ', 0, length)
+    if cut <= 0:
+        cut = length
+    return text[:cut], True
+
+class ArticleSummary(ndb.Model):
+    """
+    What the listings show of an article, written along with it as a
+    child entity. List pages run a keys-only query and read these small
+    entities instead of loading every article's full content.
+    """
+    EXCERPT_LENGTH = 300
+
+    title = ndb.StringProperty(indexed=False)
+    tags = ndb.StringProperty(repeated=True, indexed=False)
+    published_date = ndb.DateTimeProperty(indexed=False)
+    draft = ndb.BooleanProperty(indexed=False)
+    excerpt = ndb.TextProperty()
+    truncated = ndb.BooleanProperty(indexed=False)
+
+    @property
+    def article_key(self):
+        return self.key.parent()
+
+    @classmethod
+    def summary_key(cls, article_key):
+        return ndb.Key(cls, 'summary', parent=article_key)
+
+    @classmethod
+    def for_article(cls, article):
+        excerpt, truncated = make_excerpt(article.content, cls.EXCERPT_LENGTH)
+        return cls(key=cls.summary_key(article.key), title=article.title,
+                   tags=article.tags, published_date=article.published_date,
+                   draft=article.draft, excerpt=excerpt, truncated=truncated)
+
+    @classmethod
+    @ndb.tasklet
+    def get_for_articles_async(cls, article_keys):
+        """
+        Summaries of the given articles, in order. Articles saved before
+        summaries existed get theirs built and stored on the way.
+        """
+        summaries = yield ndb.get_multi_async(
+            [cls.summary_key(key) for key in article_keys])
+        missing = [key for key, summary in zip(article_keys, summaries)
+                   if summary is None]
+        if missing:
+            articles = yield ndb.get_multi_async(missing)
+            built = dict((article.key, cls.for_article(article))
+                         for article in articles if article)
+            yield ndb.put_multi_async(built.values())
+            summaries = [summary or built.get(key)
+                         for key, summary in zip(article_keys, summaries)]
+        raise ndb.Return([summary for summary in summaries if summary])
+
+def make_delta(old, new):
+    """
+    Line based delta turning ``old`` into ``new``: a list of
+    ``[start, end]`` ranges copied from the old lines and lists of new lines.
+    """
+    old_lines = (old or u'').splitlines(True)
+    new_lines = (new or u'').splitlines(True)
+    delta = []
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            delta.append([i1, i2])
+        elif j1 < j2:
+            delta.append(new_lines[j1:j2])
+    return delta
+
+def apply_delta(old, delta):
+    old_lines = (old or u'').splitlines(True)
+    new_lines = []
+    for op in delta:
+        if op and isinstance(op[0], int):
+            new_lines.extend(old_lines[op[0]:op[1]])
+        else:
+            new_lines.extend(op)
+    return u''.join(new_lines)
+
+class ArticleRevision(ndb.Model):
+    """
+    One saved revision of an article, a child of the article whose id is
+    the revision number. Every ``KEYFRAME_INTERVAL`` revisions one keeps the
+    full content; the ones in between only keep a compressed delta against
+    the revision before, so any version is rebuilt from at most
+    ``KEYFRAME_INTERVAL`` entities read with one ``get_multi``.
+    """
+    KEYFRAME_INTERVAL = 10
+
+    title = ndb.StringProperty(indexed=False)
+    content = ndb.TextProperty(compressed=True)   # keyframes only
+    delta = ndb.JsonProperty(compressed=True)     # the other revisions
+    saved_date = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+    @classmethod
+    def revision_key(cls, article_key, number):
+        return ndb.Key(cls, number, parent=article_key)
+
+    @classmethod
+    def is_keyframe(cls, number):
+        return (number - 1) % cls.KEYFRAME_INTERVAL == 0
+
+    @classmethod
+    def create(cls, article_key, number, title, old_content, new_content):
+        revision = cls(key=cls.revision_key(article_key, number), title=title)
+        if cls.is_keyframe(number):
+            revision.content = new_content
+        else:
+            revision.delta = make_delta(old_content, new_content)
+        return revision
+
+    @classmethod
+    def reconstruct(cls, article, number):
+        """
+        Title and content of revision ``number`` of an article.
+
+        :rtype: tuple or None
+        :return: (title, content), or None for an unknown revision
+        """
+        if number < 1 or number > article.revision:
+            return None
+        first = number - (number - 1) % cls.KEYFRAME_INTERVAL
+        revisions = ndb.get_multi([cls.revision_key(article.key, n)
+                                   for n in range(first, number + 1)])
+        if None in revisions:
+            return None
+        content = revisions[0].content
+        for revision in revisions[1:]:
+            content = apply_delta(content, revision.delta)
+        return revisions[-1].title, content or u''
+
+class ViewCount(ndb.Model):
+    """
+    Views of an article, counted write-behind: a view only increments a
+    memcache delta (``record_view``), and ``flush`` adds the deltas to
+    these entities in one batch from a cron job. The id is the article's
+    urlsafe key, and the entity is a root so flushing never contends
+    with the article's own writes. A delta evicted before it is flushed
+    is lost, which undercounts by at most one flush interval of views.
+    """
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+    DELTA = 'views:'           # + id: views not flushed yet
+    MARKED = 'views_marked:'   # + id: set while the id is on the dirty list
+    DIRTY = 'views_dirty'      # ids with a delta to flush
+    FLUSH_INTERVAL = 60        # seconds between flushes (cron.yaml)
+
+    @classmethod
+    def view_key(cls, article_key):
+        return ndb.Key(cls, article_key.urlsafe())
+
+    @classmethod
+    def record_view(cls, article_key):
+        view_id = article_key.urlsafe()
+        memcache.incr(cls.DELTA + view_id, initial_value=0)
+        # only the first view since the last flush touches the dirty list;
+        # the mark expires in case the list is evicted without it
+        if memcache.add(cls.MARKED + view_id, 1, time=3 * cls.FLUSH_INTERVAL):
+            cls._mark_dirty(view_id)
+
+    @classmethod
+    def _mark_dirty(cls, view_id):
+        client = memcache.Client()
+        for i in range(10):
+            dirty = client.gets(cls.DIRTY)
+            if dirty is None:
+                if client.add(cls.DIRTY, [view_id]):
+                    return
+            elif client.cas(cls.DIRTY, dirty + [view_id]):
+                return
+        # let the next view try again
+        memcache.delete(cls.MARKED + view_id)
+
+    @classmethod
+    @ndb.tasklet
+    def get_views_async(cls, article_key):
+        """
+        Views of an article: the stored count plus the delta not flushed yet.
+        """
+        stored, delta = yield (cls.view_key(article_key).get_async(),
+                               ndb.get_context().memcache_get(cls.DELTA + article_key.urlsafe()))
+        raise ndb.Return((stored.count if stored else 0) + int(delta or 0))
+
+    @classmethod
+    def flush(cls):
+        """
+        Add the buffered deltas of the dirty articles to their counts.
+        Returns the number of counts written.
+        """
+        client = memcache.Client()
+        for i in range(10):
+            view_ids = client.gets(cls.DIRTY)
+            if not view_ids or client.cas(cls.DIRTY, []):
+                break
+        else:
+            return 0
+        if not view_ids:
+            return 0
+
+        # unmark first: a view from here on lists its article again, and
+        # whatever part of its delta this flush reads is taken off below
+        view_ids = list(set(view_ids))
+        memcache.delete_multi(view_ids, key_prefix=cls.MARKED)
+        deltas = dict((view_id, int(delta)) for view_id, delta in
+                      memcache.get_multi(view_ids, key_prefix=cls.DELTA).items() if delta)
+
+        view_keys = [ndb.Key(cls, view_id) for view_id in deltas
+                     if ndb.Key(urlsafe=view_id).kind() == Article._get_kind()]
+        articles = ndb.get_multi([ndb.Key(urlsafe=key.id()) for key in view_keys])
+        counts = []
+        for key, article, count in zip(view_keys, articles, ndb.get_multi(view_keys)):
+            if article is None:
+                continue   # views of a deleted article, or of an id made up
+            count = count or cls(key=key)
+            count.count += deltas[key.id()]
+            counts.append(count)
+        ndb.put_multi(counts)
+
+        memcache.offset_multi(dict((view_id, -delta) for view_id, delta in deltas.items()),
+                              key_prefix=cls.DELTA)
+        return len(counts)
+
+
+class RenderedPage(ndb.Model):
+    """
+    Final HTML of a public blog page as an anonymous visitor sees it,
+    rendered whenever the articles it shows change. The id is the page's
+    canonical path and query (see ``blog.page_id``); ndb keeps hot copies
+    in memcache.
+    """
+    html = ndb.TextProperty()
+    rendered_date = ndb.DateTimeProperty(auto_now=True)
+
+
+class BlogStats(ndb.Model):
+    """
+    Materialized aggregates over the published articles, kept in a single
+    entity so the sidebar costs one read instead of a full Article scan.
+
+    tag_counts = { 'tagName1': 10, 'tagName2': 20 }
+    month_counts = { '2016-02': 3, '2016-03': 1 }
+
+    The list of the articles themselves grows with the blog, so it is kept
+    apart in ``BlogArchive``, a child of this entity: reading the counters
+    never loads it, and both are still written in one transaction.
+
+    The admin handlers keep them up to date through ``record_change``; if
+    either entity is missing both are rebuilt from the articles on the
+    next read.
+    """
+    tag_counts = ndb.JsonProperty()
+    month_counts = ndb.JsonProperty()
+
+    @classmethod
+    def stats_key(cls):
+        return ndb.Key(cls, 'blog')
+
+    @classmethod
+    def get_stats(cls):
+        return cls.get_stats_async().get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_stats_async(cls):
+        stats = yield cls.stats_key().get_async()
+        if stats is None or stats.is_outdated():
+            stats, archive = cls.rebuild()
+        raise ndb.Return(stats)
+
+    @classmethod
+    def get_archive(cls):
+        return cls.get_archive_async().get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_archive_async(cls):
+        """
+        { 'urlsafe': [title, '2016-02-01T10:00:00', ['tag1', 'tag2']] }
+        over the published articles.
+        """
+        archive = yield BlogArchive.archive_key().get_async()
+        if archive is None:
+            stats, archive = cls.rebuild()
+        raise ndb.Return(archive.articles)
+
+    @classmethod
+    def rebuild(cls):
+        """
+        Recompute every aggregate with one pass over the published articles.
+
+        :rtype: tuple
+        :return: (BlogStats, BlogArchive)
+        """
+        stats = cls(key=cls.stats_key(), tag_counts={}, month_counts={})
+        archive = BlogArchive(key=BlogArchive.archive_key(), articles={})
+        for article in Article.published():
+            stats.apply_state(article.live_state(), 1, archive.articles)
+        ndb.put_multi([stats, archive])
+        return stats, archive
+
+    @classmethod
+    def record_change(cls, before, after):
+        """
+        Move an article's contribution from ``before`` to ``after``, both
+        being values returned by ``Article.live_state()`` (None for a draft
+        or a deleted article).
+        """
+        cls.record_changes([(before, after)])
+
+    @classmethod
+    def record_changes(cls, changes):
+        """
+        Apply a batch of (before, after) changes in a single transaction.
+        """
+        changes = [(before, after) for before, after in changes if before != after]
+        if changes and not cls._record_changes_txn(changes):
+            # Nothing materialized yet. The rebuild's query may not see
+            # these changes yet, so they are applied on top of it; that is
+            # harmless if it does, see apply_state.
+            cls.rebuild()
+            cls._record_changes_txn(changes)
+
+    @classmethod
+    @ndb.transactional
+    def _record_changes_txn(cls, changes):
+        stats, archive = ndb.get_multi([cls.stats_key(), BlogArchive.archive_key()])
+        if stats is None or stats.is_outdated() or archive is None:
+            return False
+        for before, after in changes:
+            stats.apply_state(before, -1, archive.articles)
+            stats.apply_state(after, 1, archive.articles)
+        ndb.put_multi([stats, archive])
+        return True
+
+    def is_outdated(self):
+        """
+        True when the entity was written before one of the aggregates
+        existed, or while it still held the archive, in which case it has
+        to be rebuilt.
+        """
+        return (self.tag_counts is None or self.month_counts is None or
+                'archive' in self._properties)
+
+    def apply_state(self, state, delta, archive):
+        """
+        Add (``delta`` 1) or remove (-1) an article. The counters follow
+        what the archive holds for it, so applying a state the archive
+        already reflects changes nothing.
+        """
+        if state is None:
+            return
+        old = archive.pop(state['key'], None)
+        if old:
+            title, published, tags = old
+            for tag in tags:
+                self._add(self.tag_counts, tag, -1)
+            self._add(self.month_counts, published[:7], -1)
+        if delta > 0:
+            archive[state['key']] = [state['title'], state['published'],
+                                     state['tags']]
+            for tag in state['tags']:
+                self._add(self.tag_counts, tag, 1)
+            self._add(self.month_counts, state['month'], 1)
+
+    @staticmethod
+    def _add(counts, name, delta):
+        count = counts.get(name, 0) + delta
+        if count > 0:
+            counts[name] = count
+        else:
+            counts.pop(name, None)
+
+
+class BlogArchive(ndb.Model):
+    """
+    Every published article as { 'urlsafe': [title, published, tags] },
+    the child of ``BlogStats`` that the sidebar archive, the related
+    articles and the stored listings are built from. Compressed, since it
+    grows with every post.
+    """
+    articles = ndb.JsonProperty(compressed=True)
+
+    @classmethod
+    def archive_key(cls):
+        return ndb.Key(cls, 'archive', parent=BlogStats.stats_key())
+
+
+class RelatedArticles(ndb.Model):
+    """
+    The articles most related to one published article, ranked by the
+    Jaccard similarity of their tag sets. Stored as a child of the article
+    so the article page reads one small entity:
+
+    articles = [ ['urlsafe', title, 0.5], ... ]
+
+    The lists are computed from the ``BlogArchive`` by the admin
+    tasks (see ``update``) after a write changes tags or titles.
+    """
+    MAX_RELATED = 5
+
+    articles = ndb.JsonProperty()
+
+    @classmethod
+    def related_key(cls, article_key):
+        return ndb.Key(cls, 'related', parent=article_key)
+
+    @staticmethod
+    def tag_index(archive):
+        """
+        { 'tag': set(['urlsafe', ...]) } over the archive.
+        """
+        index = {}
+        for urlsafe, (title, published, tags) in archive.iteritems():
+            for tag in tags:
+                index.setdefault(tag, set()).add(urlsafe)
+        return index
+
+    @classmethod
+    def rank(cls, archive, index, urlsafe):
+        """
+        Ranked list for one article, only looking at the articles sharing
+        at least one of its tags.
+        """
+        tags = set(archive[urlsafe][2])
+        candidates = set()
+        for tag in tags:
+            candidates |= index.get(tag, set())
+        candidates.discard(urlsafe)
+
+        scored = []
+        for other in candidates:
+            title, published, other_tags = archive[other]
+            other_tags = set(other_tags)
+            score = float(len(tags & other_tags)) / len(tags | other_tags)
+            scored.append((score, published, other, title))
+        scored.sort(reverse=True)
+        return [[other, title, round(score, 3)]
+                for score, published, other, title in scored[:cls.MAX_RELATED]]
+
+    @classmethod
+    def update(cls, urlsafes):
+        """
+        Recompute the lists of the given articles, writing only those that
+        changed and dropping the lists of articles no longer published.
+
+        :rtype: list
+        :return: urlsafe keys of the articles whose list changed
+        """
+        archive = BlogStats.get_archive()
+        index = cls.tag_index(archive)
+        keys = [cls.related_key(ndb.Key(urlsafe=urlsafe)) for urlsafe in urlsafes]
+
+        changed = []
+        puts = []
+        deletes = []
+        for urlsafe, key, stored in zip(urlsafes, keys, ndb.get_multi(keys)):
+            if urlsafe not in archive:
+                if stored:
+                    deletes.append(key)
+                    changed.append(urlsafe)
+                continue
+            articles = cls.rank(archive, index, urlsafe)
+            if stored is None or stored.articles != articles:
+                puts.append(cls(key=key, articles=articles))
+                changed.append(urlsafe)
+        ndb.put_multi(puts)
+        ndb.delete_multi(deletes)
+        return changed
+
+    @classmethod
+    def neighbours(cls, tags):
+        """
+        urlsafe keys of the published articles carrying any of ``tags``.
+        """
+        archive = BlogStats.get_archive()
+        return [urlsafe for urlsafe, (title, published, article_tags)
+                in archive.iteritems() if set(tags) & set(article_tags)]
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""
+Runs the blog and admin WSGI apps from many threads at once against the
+testbed stubs, checking that every response shows what was asked for and
+nothing of another request. Needs the App Engine SDK: put it on the path
+or point GAE_SDK_ROOT at it, otherwise the test is skipped.
+
+    GAE_SDK_ROOT=/path/to/google_appengine python test_concurrency.py
+"""
+
+import os
+import re
+import sys
+import threading
+import unittest
+
+BLOG_DIR = os.path.dirname(os.path.abspath(__file__))
+
+if os.environ.get('GAE_SDK_ROOT'):
+    sys.path.insert(0, os.environ['GAE_SDK_ROOT'])
+try:
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    from google.appengine.ext import testbed
+    from google.appengine.datastore import datastore_stub_util
+except ImportError:
+    testbed = None
+
+THREADS = 8
+ROUNDS = 25
+ARTICLES = 6
+
+
+@unittest.skipIf(testbed is None, 'the App Engine SDK is not installed')
+class ConcurrentRequestsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # queries see every write at once, so the checks below are exact
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_user_stub()
+        self.testbed.init_taskqueue_stub(root_path=BLOG_DIR)
+        # the user environment is process wide, so all the threads of a
+        # run are the same user: the admin first, then anonymous visitors
+        self.testbed.setup_env(USER_EMAIL='admin@example.com', USER_ID='1',
+                               USER_IS_ADMIN='1', overwrite=True)
+
+        if BLOG_DIR not in sys.path:
+            sys.path.insert(0, BLOG_DIR)
+        import blog
+        import admin
+        self.blog = blog
+        self.admin = admin
+
+        self.articles = {}   # urlsafe: (title, tag)
+        for i in range(ARTICLES):
+            title = 'Article number %d' % i
+            tag = 'even' if i % 2 == 0 else 'odd'
+            response = self.request(admin.app, '/admin/EditArticle', {
+                'title': title, 'content': '<p>Body of %s</p>' % title,
+                'tags': tag, 'decision': 'P'})
+            aid = response.headers['Location'].split('aid=')[1]
+            self.articles[aid] = (title, tag)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def request(self, app, path, post=None):
+        import webapp2
+        request = webapp2.Request.blank(path, POST=post)
+        return request.get_response(app)
+
+    def check_article(self, app, path, aid):
+        response = self.request(app, '%s?aid=%s' % (path, aid))
+        self.assertEqual(response.status_int, 200)
+        title, tag = self.articles[aid]
+        # the article itself, and no other article's body
+        self.assertIn('Body of %s' % title, response.body)
+        self.assertEqual(re.findall(r'Body of (Article number \d+)', response.body),
+                         [title])
+
+    def check_tag(self, app, path, tag):
+        response = self.request(app, '%s?tag=%s' % (path, tag))
+        self.assertEqual(response.status_int, 200)
+        expected = set(title for title, article_tag in self.articles.values()
+                       if article_tag == tag)
+        # the listing's headings, not the sidebar archive
+        listed = set(re.findall(r'color:darkgreen;" href="[^"]*">(Article number \d+)</a></h3>',
+                                response.body))
+        self.assertTrue(listed, 'no article listed for tag %s' % tag)
+        self.assertTrue(listed <= expected, 'tag %s listed %s' % (tag, listed - expected))
+
+    def check_edit(self, aid, number, round_number):
+        # a real save (new revision, stored pages rendered again) that
+        # keeps the title, tag and body line the other checks look for
+        title, tag = self.articles[aid]
+        response = self.request(self.admin.app, '/admin/EditArticle', {
+            'aid': aid, 'tags': tag, 'decision': 'P', 'title': title,
+            'content': '<p>Body of %s</p><p>edit %d.%d</p>' % (title, number, round_number)})
+        self.assertEqual(response.status_int, 302)
+
+    def admin_worker(self, number, errors):
+        aids = sorted(self.articles)
+        try:
+            for round_number in range(ROUNDS):
+                aid = aids[(number + round_number) % len(aids)]
+                tag = ('even', 'odd')[(number + round_number) % 2]
+                self.check_article(self.blog.app, '/Article', aid)
+                self.check_article(self.admin.app, '/admin/Article', aid)
+                self.check_tag(self.blog.app, '/', tag)
+                self.check_tag(self.admin.app, '/admin', tag)
+                if round_number % 5 == number % 5:
+                    self.check_edit(aid, number, round_number)
+        except Exception as e:
+            errors.append('thread %d: %r' % (number, e))
+
+    def anonymous_worker(self, number, errors):
+        # anonymous visitors are served the stored copies of the pages
+        aids = sorted(self.articles)
+        try:
+            for round_number in range(ROUNDS):
+                aid = aids[(number + round_number) % len(aids)]
+                tag = ('even', 'odd')[(number + round_number) % 2]
+                self.check_article(self.blog.app, '/Article', aid)
+                self.check_tag(self.blog.app, '/', tag)
+                response = self.request(self.blog.app, '/feed')
+                self.assertEqual(response.status_int, 200)
+                self.assertEqual(self.titles(response.body), set(
+                    title for title, article_tag in self.articles.values()))
+        except Exception as e:
+            errors.append('thread %d: %r' % (number, e))
+
+    def titles(self, body):
+        return set(re.findall(r'Article number \d+', body))
+
+    def run_threads(self, worker):
+        errors = []
+        threads = [threading.Thread(target=worker, args=(number, errors))
+                   for number in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_concurrent_requests(self):
+        self.run_threads(self.admin_worker)
+
+        self.testbed.setup_env(USER_EMAIL='', USER_ID='', USER_IS_ADMIN='0',
+                               overwrite=True)
+        self.run_threads(self.anonymous_worker)
+
+        # the aggregates saw every article exactly once
+        stats = self.blog.BlogStats.get_stats()
+        self.assertEqual(stats.tag_counts, {'even': ARTICLES // 2,
+                                            'odd': ARTICLES - ARTICLES // 2})
+
+
+if __name__ == '__main__':
+    unittest.main()